@@ -33,3 +33,18 @@ __copyright__ = "Copyright 2018, Xilinx"
 __email__ = ""
 
 from .darius_lib import *
+from .reference import *
+from .virtual_device import *
+from .latency_model import *
+from .program import *
+from .tiling import *
+from .buffer_pool import *
+from .executor import *
+from .compiler import *
+from .batch import *
+from .quantize import *
+from .packed import *
+from .hybrid import *
+from .trace import *
+from .ingest import *
+from .sharding import *
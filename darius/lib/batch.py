@@ -0,0 +1,171 @@
+#   Copyright (c) 2018, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import copy
+import numpy as np
+from .darius_lib import C_MAX_INPUT_WIDTH, C_NUM_OF_ROWS, C_NUM_OF_COLS
+from .darius_lib import _hw_view, _lane_ranges, pack_slices
+from .program import Program
+from .latency_model import DEFAULT_CLOCK_MHZ
+from .trace import traced
+
+__author__ = ""
+__copyright__ = "Copyright 2018, Xilinx"
+__email__ = "pynq_support@xilinx.com"
+
+
+class BatchedLayer(object):
+    """ A Darius layer run on a batch of IFM volumes with one IP start
+
+    The batch IFMs are packed into consecutive IFM regions from the layer's
+    ifm_baseaddr and the OFMs are written to consecutive OFM regions from
+    its ofm_baseaddr; every command reads the same packed weights, so the
+    weights are loaded once for the whole batch.
+
+    The ifm, weights and ofm buffers hold ifm_length, weights_length and
+    ofm_length elements from their base addresses """
+
+    def __init__(self, layer, batch):
+        if batch < 1:
+            raise ValueError("Batch size has to be at least 1")
+        self.layer = layer
+        self.batch = batch
+        self.ifm_image_length = layer.ifm_packet_length * C_NUM_OF_ROWS
+        self.ofm_image_length = layer.ofm_packet_length * C_NUM_OF_COLS
+        self.ifm_length = self.ifm_image_length * batch
+        self.ofm_length = self.ofm_image_length * batch
+        self.weights_length = layer.weight_depth_offset * layer.ofm_slices
+
+    @property
+    def num_commands(self):
+        return self.batch
+
+    def memory(self):
+        """ Bytes of physical memory the ifm, weights and ofm buffers of the
+        batch take, to size batches against the CMA budget """
+        word = C_MAX_INPUT_WIDTH // 8
+        return (self.ifm_length + self.weights_length +
+                self.ofm_length) * word
+
+    def ofm_shape(self):
+        """ Shape (batch, channels, height, width) of the OFM volumes """
+        return (self.batch,) + self.layer.ofm_shape()
+
+    def program(self):
+        """ Program holding the command of every image, on the current base
+        addresses of the layer """
+        word = C_MAX_INPUT_WIDTH // 8
+        program = Program()
+        for i in range(self.batch):
+            image = copy.copy(self.layer)
+            image.ifm_baseaddr += i * self.ifm_image_length * word
+            image.ofm_baseaddr += i * self.ofm_image_length * word
+            program.add(image, chain=False)
+        return program
+
+    def IP_cmd(self):
+        """ Concatenated commands of all images """
+        return self.program().IP_cmd()
+
+    @traced('pack_ifm')
+    def reshape_and_copy_ifm(self, ifm_sw, ifm):
+        """ Pack a row-major (batch, depth, height, width) array of IFM
+        volumes to physical memory with ifm pointer in one transform """
+        layer = self.layer
+        plane = layer.ifm_height * layer.ifm_width
+        src = np.asarray(ifm_sw).reshape(self.batch, -1)
+        src = src[:, :layer.ifm_depth * plane]
+        dst = _hw_view(ifm, (self.batch, layer.ifm_slices, plane,
+                             C_NUM_OF_ROWS))
+        pack_slices(src.reshape(self.batch, layer.ifm_depth,
+                                plane).swapaxes(0, 1),
+                    dst.swapaxes(0, 1))
+
+    def reshape_and_copy_weights(self, weights_sw, weights):
+        """ Pack the weights shared by the batch to physical memory with
+        weights pointer """
+        self.layer.reshape_and_copy_weights(weights_sw, weights)
+
+    @traced('unpack')
+    def unpack_ofm(self, ofm, out=None, **unpack_args):
+        """ Reshape the OFM volumes written by the IP back to a row-major
+        (batch, channels, height, width) array in one transform
+
+        Post-ops (bias, relu, shift) are forwarded to Darius.unpack_ofm for
+        each image """
+        shape = self.ofm_shape()
+        if out is None:
+            out = np.empty(shape, dtype=ofm.dtype)
+        elif out.shape != shape:
+            raise ValueError("OFM output buffer has shape %s, expected %s"
+                             % (out.shape, shape))
+        if unpack_args:
+            for i in range(self.batch):
+                self.layer.unpack_ofm(
+                    ofm[i * self.ofm_image_length:], out=out[i],
+                    **unpack_args)
+            return out
+
+        batch, channels, height, width = shape
+        hw = _hw_view(ofm, (batch, self.layer.ofm_slices, height, width,
+                            C_NUM_OF_COLS))
+        for first, last, lanes in _lane_ranges(channels, C_NUM_OF_COLS):
+            block = out[:, first * C_NUM_OF_COLS:
+                        first * C_NUM_OF_COLS + (last - first) * lanes]
+            block = block.reshape(batch, last - first, lanes, height, width)
+            np.copyto(block, hw[:, first:last, ..., :lanes].transpose(
+                0, 1, 4, 2, 3), casting='unsafe')
+        return out
+
+    def throughput(self, seconds, hw_cycles=None,
+                   clock_mhz=DEFAULT_CLOCK_MHZ):
+        """ Per image latency and images per second of a batch run that
+        took seconds end to end and optionally hw_cycles on the IP """
+        report = {
+            'Batch Size': self.batch,
+            'Seconds Per Image': seconds / self.batch,
+            'Images Per Second': self.batch / seconds if seconds else 0.0,
+            'Memory': self.memory(),
+        }
+        if hw_cycles is not None:
+            hw_seconds = hw_cycles / (clock_mhz * 1e6)
+            report['HW Seconds Per Image'] = hw_seconds / self.batch
+            report['HW Images Per Second'] = \
+                self.batch / hw_seconds if hw_seconds else 0.0
+        return report
+
+
+def max_batch(layer, cma_budget):
+    """ Largest batch of layer whose buffers fit in cma_budget bytes """
+    word = C_MAX_INPUT_WIDTH // 8
+    image = (layer.ifm_packet_length * C_NUM_OF_ROWS +
+             layer.ofm_packet_length * C_NUM_OF_COLS) * word
+    weights = layer.weight_depth_offset * layer.ofm_slices * word
+    return max((cma_budget - weights) // image, 0)
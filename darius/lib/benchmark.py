@@ -0,0 +1,261 @@
+#   Copyright (c) 2018, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+""" Benchmarks of the darius_lib hot paths, run off-board with NumPy only
+
+    python -m darius.lib.benchmark --history bench.jsonl --baseline base.json
+
+Every run is appended to the JSON lines history file; with --baseline the
+run is compared to the saved baseline and the exit status is 1 when a
+benchmark is slower than its threshold allows. --save-baseline writes the
+run as the new baseline """
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import sys
+import time
+import numpy as np
+from .darius_lib import Darius, C_NUM_OF_ROWS
+from .reference import run_IP_cmd
+from .hybrid import cpu_conv
+
+__author__ = ""
+__copyright__ = "Copyright 2018, Xilinx"
+__email__ = "pynq_support@xilinx.com"
+
+# (ifm dimension, ifm depth, channels) of the benchmarked layers
+BENCHMARK_VOLUMES = ((6, 8, 8), (16, 64, 64), (32, 512, 512))
+BENCHMARK_KERNELS = (1, 3, 5)
+BENCHMARK_POOLS = (0, 2)
+BENCHMARK_STAGES = ('pack_ifm', 'pack_weights', 'build_cmd', 'unpack',
+                    'reference', 'cpu_conv')
+# Slowdown over the baseline reported as a regression
+DEFAULT_THRESHOLD = 0.10
+
+
+def benchmark_layers(volumes=BENCHMARK_VOLUMES, kernels=BENCHMARK_KERNELS,
+                     pools=BENCHMARK_POOLS):
+    """ (name, layer) of every supported layer of the shape matrix; the
+    padding keeps the output plane at the IFM size """
+    layers = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for dimension, depth, channels in volumes:
+            for kernel in kernels:
+                for pool in pools:
+                    layer = Darius(dimension, dimension, depth, kernel,
+                                   kernel, kernel // 2, 1, channels, pool,
+                                   pool, pool, 0, 0, 0)
+                    # Darius turns the maxpool off when its output is too
+                    # small, which repeats the layer without pool
+                    name = "%dx%dx%d-k%d-c%d-p%d" % (
+                        dimension, dimension, depth, kernel, channels,
+                        layer.pool_stride)
+                    if name in layers or layer.IP_cmd() is False:
+                        continue
+                    layers[name] = layer
+    return list(layers.items())
+
+
+def time_call(func, min_time=0.05, repeat=5):
+    """ Median and best time of one call of func in seconds; each of the
+    repeat measurements loops func for at least min_time """
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or loops >= 1 << 20:
+            break
+        loops *= 2 if elapsed == 0 else \
+            max(2, min(int(min_time / elapsed) + 1, 10))
+    times = [elapsed / loops]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        times.append((time.perf_counter() - start) / loops)
+    return {'median': float(np.median(times)), 'best': float(min(times)),
+            'loops': loops}
+
+
+def _stages(layer, rng):
+    """ Callables of every benchmark stage of a layer """
+    ifm_sw = rng.randint(-64, 64, layer.ifm_depth * layer.ifm_height *
+                         layer.ifm_width, dtype=np.int16)
+    weights_sw = rng.randint(-64, 64, layer.channels * layer.weight_offset,
+                             dtype=np.int16)
+    ifm = np.zeros(layer.ifm_packet_length * C_NUM_OF_ROWS, dtype=np.int16)
+    weights = np.zeros(layer.weight_depth_offset * layer.ofm_slices,
+                       dtype=np.int16)
+    layer.reshape_and_copy_ifm(ifm_sw, ifm)
+    layer.reshape_and_copy_weights(weights_sw, weights)
+    cmd = layer.IP_cmd()
+    ofm = run_IP_cmd(cmd, ifm, weights)
+    out = np.empty(layer.ofm_shape(), dtype=np.int16)
+    return {
+        'pack_ifm': lambda: layer.reshape_and_copy_ifm(ifm_sw, ifm),
+        'pack_weights': lambda: layer.reshape_and_copy_weights(weights_sw,
+                                                               weights),
+        'build_cmd': layer.IP_cmd,
+        'unpack': lambda: layer.unpack_ofm(ofm, out=out),
+        'reference': lambda: run_IP_cmd(cmd, ifm, weights, ofm),
+        'cpu_conv': lambda: cpu_conv(layer, ifm_sw, weights_sw),
+    }
+
+
+def run_benchmarks(layers=None, stages=BENCHMARK_STAGES, select=None,
+                   min_time=0.05, repeat=5, seed=0):
+    """ Run the benchmarks and return the run as a JSON serializable dict;
+    select keeps only the benchmarks whose name contains it """
+    if layers is None:
+        layers = benchmark_layers()
+    rng = np.random.RandomState(seed)
+    results = {}
+    # Darius reports every command it builds on stdout
+    with contextlib.redirect_stdout(io.StringIO()):
+        for layer_name, layer in layers:
+            calls = None
+            for stage in stages:
+                name = "%s/%s" % (stage, layer_name)
+                if select is not None and select not in name:
+                    continue
+                if calls is None:
+                    calls = _stages(layer, rng)
+                results[name] = time_call(calls[stage], min_time, repeat)
+    return {'timestamp': time.time(),
+            'machine': {'node': platform.node(),
+                        'machine': platform.machine(),
+                        'python': platform.python_version(),
+                        'numpy': np.__version__},
+            'results': results}
+
+
+def threshold_for(name, threshold=DEFAULT_THRESHOLD, thresholds=None):
+    """ Threshold of a benchmark: the one of the longest prefix of its
+    name in thresholds, else threshold """
+    best = None
+    for prefix in (thresholds or {}):
+        if name.startswith(prefix) and (best is None or
+                                        len(prefix) > len(best)):
+            best = prefix
+    return threshold if best is None else thresholds[best]
+
+
+def compare(run, baseline, threshold=DEFAULT_THRESHOLD, thresholds=None):
+    """ Compare the median times of a run with a baseline run
+
+    Returns (name, baseline seconds, run seconds, ratio, regressed) of every
+    benchmark in both; a benchmark regressed when it is more than its
+    threshold (a fraction) slower than the baseline """
+    rows = []
+    for name, result in sorted(run['results'].items()):
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        ratio = result['median'] / base['median'] if base['median'] else 1.0
+        limit = threshold_for(name, threshold, thresholds)
+        rows.append((name, base['median'], result['median'], ratio,
+                     ratio > 1.0 + limit))
+    return rows
+
+
+def load_history(path):
+    """ All runs of a JSON lines history file """
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def append_history(path, run):
+    with open(path, 'a') as f:
+        f.write(json.dumps(run) + "\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the darius_lib hot paths")
+    parser.add_argument('--history', help="JSON lines file runs are "
+                        "appended to")
+    parser.add_argument('--baseline', help="JSON file of the baseline run")
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="write this run to --baseline")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed slowdown over the baseline, as a "
+                        "fraction")
+    parser.add_argument('--stage-threshold', action='append', default=[],
+                        metavar='PREFIX=FRACTION',
+                        help="allowed slowdown of the benchmarks whose "
+                        "name starts with PREFIX")
+    parser.add_argument('--select', help="run only benchmarks whose name "
+                        "contains this")
+    parser.add_argument('--quick', action='store_true',
+                        help="small and medium layers, shorter timing")
+    args = parser.parse_args(argv)
+    if args.save_baseline and not args.baseline:
+        parser.error("--save-baseline needs --baseline")
+
+    thresholds = {}
+    for item in args.stage_threshold:
+        prefix, _, value = item.partition('=')
+        thresholds[prefix] = float(value)
+    if args.quick:
+        run = run_benchmarks(benchmark_layers(BENCHMARK_VOLUMES[:2]),
+                             select=args.select, min_time=0.01, repeat=3)
+    else:
+        run = run_benchmarks(select=args.select)
+
+    for name, result in sorted(run['results'].items()):
+        print("%-40s %12.1f us" % (name, result['median'] * 1e6))
+    if args.history:
+        append_history(args.history, run)
+
+    status = 0
+    if args.baseline and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        rows = compare(run, baseline, args.threshold, thresholds)
+        regressions = [row for row in rows if row[4]]
+        for name, base, current, ratio, _ in regressions:
+            print("REGRESSION: %s %.1f us -> %.1f us (%.2fx)"
+                  % (name, base * 1e6, current * 1e6, ratio))
+        print("%d of %d benchmarks regressed" % (len(regressions),
+                                                  len(rows)))
+        status = 1 if regressions else 0
+    elif args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(run, f, indent=1)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,223 @@
+#   Copyright (c) 2018, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import threading
+import numpy as np
+
+__author__ = ""
+__copyright__ = "Copyright 2018, Xilinx"
+__email__ = "pynq_support@xilinx.com"
+
+# Smallest size class, one page of contiguous memory
+MIN_SIZE_CLASS = 4096
+
+
+def size_class(nbytes):
+    """ Power of two size class in bytes of an allocation """
+    size = MIN_SIZE_CLASS
+    while size < nbytes:
+        size <<= 1
+    return size
+
+
+class PoolBuffer(np.ndarray):
+    """ Array handed out by a BufferPool; freebuffer() returns it to the
+    pool instead of the backend """
+
+    def freebuffer(self):
+        pool = getattr(self, 'pool', None)
+        if pool is not None:
+            pool.free(self)
+
+    def flush(self):
+        self.block.flush()
+
+    def invalidate(self):
+        self.block.invalidate()
+
+
+class BufferPool(object):
+    """ Pool of physically contiguous buffers for the darius package
+
+    Requests are rounded up to power of two size classes and served from
+    buffers freed earlier when possible, so a long running process does not
+    fragment the CMA region by allocating and freeing on every call. Memory
+    comes from a backend with the cma_array/cma_stats interface of
+    pynq.Xlnk, which is the default; VirtualMemory serves as a plain NumPy
+    backend off-board. At most max_cached bytes of free buffers are kept,
+    the rest go back to the backend """
+
+    def __init__(self, backend=None, max_cached=64 << 20):
+        if backend is None:
+            from pynq import Xlnk
+            backend = Xlnk()
+        self.backend = backend
+        self.max_cached = max_cached
+        self._lock = threading.Lock()
+        self._free = {}
+        self._cached = 0
+        self._in_use = {}
+        self._requested = 0
+        self.hits = 0
+        self.misses = 0
+
+    def allocate(self, shape, dtype=np.uint32):
+        """ Contiguous array of the given shape and dtype """
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        size = size_class(nbytes)
+        with self._lock:
+            blocks = self._free.get(size)
+            if blocks:
+                block = blocks.pop()
+                self._cached -= size
+                self.hits += 1
+            else:
+                block = None
+                self.misses += 1
+        if block is None:
+            block = self.backend.cma_array(size, dtype=np.uint8)
+
+        buf = block[:nbytes].view(dtype).reshape(shape).view(PoolBuffer)
+        buf.physical_address = block.physical_address
+        buf.block = block
+        buf.pool = self
+        with self._lock:
+            self._in_use[block.physical_address] = (block, nbytes)
+            self._requested += nbytes
+        return buf
+
+    cma_array = allocate
+
+    def free(self, buf):
+        """ Return a buffer to the pool """
+        with self._lock:
+            block, nbytes = self._in_use.pop(buf.physical_address)
+            self._requested -= nbytes
+            buf.pool = None
+            if self._cached + block.size <= self.max_cached:
+                self._free.setdefault(block.size, []).append(block)
+                self._cached += block.size
+                block = None
+        if block is not None:
+            block.freebuffer()
+
+    def pingpong(self, shape, dtype=np.uint32):
+        """ Pair of buffers for chaining layers through alternate OFMs """
+        return PingPong(self.allocate(shape, dtype),
+                        self.allocate(shape, dtype))
+
+    def trim(self):
+        """ Give every cached buffer back to the backend """
+        with self._lock:
+            blocks = [block for blocks in self._free.values()
+                      for block in blocks]
+            self._free = {}
+            self._cached = 0
+        for block in blocks:
+            block.freebuffer()
+
+    def stats(self):
+        """ Pool statistics next to the backend's cma_stats() """
+        with self._lock:
+            in_use = sum(block.size for block, _ in self._in_use.values())
+            requests = self.hits + self.misses
+            stats = {
+                'Buffers In Use': len(self._in_use),
+                'Cached Buffers': sum(len(blocks)
+                                      for blocks in self._free.values()),
+                'In Use Memory': in_use,
+                'Requested Memory': self._requested,
+                'Cached Memory': self._cached,
+                'Hit Rate': self.hits / requests if requests else 0.0,
+                'Fragmentation': 1.0 - self._requested / in_use
+                if in_use else 0.0,
+                'Size Classes': {size: len(blocks)
+                                 for size, blocks in self._free.items()
+                                 if blocks},
+            }
+        stats.update(self.backend.cma_stats())
+        return stats
+
+    cma_stats = stats
+
+
+class PingPong(object):
+    """ Two equally sized buffers used alternately as the OFM of a layer
+    and the IFM of the next one """
+
+    def __init__(self, ping, pong):
+        self.buffers = [ping, pong]
+        self.index = 0
+
+    @property
+    def current(self):
+        return self.buffers[self.index]
+
+    @property
+    def next(self):
+        return self.buffers[1 - self.index]
+
+    def swap(self):
+        """ Make the next buffer current and return it """
+        self.index = 1 - self.index
+        return self.current
+
+    def freebuffer(self):
+        for buf in self.buffers:
+            buf.freebuffer()
+
+
+class NamedBuffers(object):
+    """ Buffers from a pool kept by name across runs, such as the IFM,
+    weights and OFM buffers of a driver; a buffer is only replaced when a
+    run needs it larger """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.buffers = {}
+
+    def get(self, name, size, dtype=np.int16):
+        """ Buffer name of at least size elements """
+        buf = self.buffers.get(name)
+        if buf is None or buf.size < size:
+            if buf is not None:
+                buf.freebuffer()
+            buf = self.pool.allocate(size, dtype)
+            self.buffers[name] = buf
+        return buf
+
+    def __getitem__(self, name):
+        return self.buffers[name]
+
+    def freebuffer(self):
+        for buf in self.buffers.values():
+            buf.freebuffer()
+        self.buffers = {}
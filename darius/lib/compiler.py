@@ -0,0 +1,200 @@
+#   Copyright (c) 2018, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import json
+import struct
+import numpy as np
+from .darius_lib import Darius, IP_CMD_LENGTH, C_MAX_INPUT_WIDTH
+from .darius_lib import C_NUM_OF_COLS, C_NUM_OF_ROWS, IP_start, IP_wait
+from .program import Program
+from .buffer_pool import BufferPool
+
+__author__ = ""
+__copyright__ = "Copyright 2018, Xilinx"
+__email__ = "pynq_support@xilinx.com"
+
+# Arguments of Darius stored for every layer of a compiled network
+DARIUS_ARGS = ('ifm_height', 'ifm_width', 'ifm_depth', 'kernel_height',
+               'kernel_width', 'pad', 'stride', 'channels',
+               'pool_kernel_height', 'pool_kernel_width', 'pool_stride')
+
+COMPILED_MAGIC = b'DARIUSNN'
+COMPILED_VERSION = 1
+# magic, version, metadata length, arena size, weights offset in the arena,
+# weights length, commands offset in the arena, number of commands,
+# weights offset in the file, commands offset in the file
+COMPILED_HEADER = struct.Struct('<8sIIQQQQIQQ')
+COMPILED_ALIGNMENT = 4096
+# Word index of the ifm, ofm and weights base addresses in a command
+CMD_ADDRESS_WORDS = (6, 10, 12)
+
+
+def _align(offset):
+    return -(-offset // COMPILED_ALIGNMENT) * COMPILED_ALIGNMENT
+
+
+def compile_network(layers, weights, path):
+    """ Compile a stack of Darius layers and their row-major weights into
+    one file holding the pre-packed weights, the commands and the buffer
+    plan, to be opened with CompiledNetwork
+
+    All buffers live in one arena: the packed weights of every layer, an
+    input buffer and two ping-pong buffers for the layer outputs, then the
+    commands. Command addresses are stored relative to the arena and
+    relocated when the file is loaded """
+    if len(weights) != len(layers):
+        raise ValueError("Network of %d layers has %d weights"
+                         % (len(layers), len(weights)))
+    word = C_MAX_INPUT_WIDTH // 8
+    configs = [{arg: getattr(layer, arg) for arg in DARIUS_ARGS}
+               for layer in layers]
+    plain = [Darius(*[config[arg] for arg in DARIUS_ARGS], 0, 0, 0)
+             for config in configs]
+
+    offset = 0
+    weights_offsets = []
+    for layer in plain:
+        weights_offsets.append(offset)
+        offset = _align(offset + layer.weight_depth_offset *
+                        layer.ofm_slices * word)
+    weights_length = offset
+    input_offset = offset
+    offset = _align(offset + plain[0].ifm_packet_length * C_NUM_OF_ROWS * word)
+    ofm_size = max(layer.ofm_packet_length * C_NUM_OF_COLS * word
+                   for layer in plain)
+    pingpong_offsets = [offset, _align(offset + ofm_size)]
+    cmd_offset = _align(pingpong_offsets[1] + ofm_size)
+    arena_size = _align(cmd_offset + len(plain) * IP_CMD_LENGTH)
+
+    program = Program()
+    for i, config in enumerate(configs):
+        layer = Darius(*[config[arg] for arg in DARIUS_ARGS],
+                       input_offset, weights_offsets[i],
+                       pingpong_offsets[i % 2])
+        program.add(layer)
+    cmds = program.IP_cmd()
+    if cmds is False:
+        raise ValueError("Network is not supported by the CNNDataflow IP")
+
+    image = np.zeros(weights_length, dtype=np.uint8)
+    for layer, layer_weights, weights_offset in zip(program.layers, weights,
+                                                    weights_offsets):
+        layer.reshape_and_copy_weights(
+            layer_weights, image[weights_offset:].view('int%d' %
+                                                       C_MAX_INPUT_WIDTH))
+
+    metadata = json.dumps({
+        'layers': configs,
+        'input_offset': input_offset,
+        'output_offset': pingpong_offsets[(len(plain) - 1) % 2],
+        'weights_offsets': weights_offsets,
+    }).encode()
+    file_weights = _align(COMPILED_HEADER.size + len(metadata))
+    file_cmds = _align(file_weights + weights_length)
+    with open(path, 'wb') as f:
+        f.write(COMPILED_HEADER.pack(COMPILED_MAGIC, COMPILED_VERSION,
+                                     len(metadata), arena_size, 0,
+                                     weights_length, cmd_offset,
+                                     len(plain), file_weights, file_cmds))
+        f.write(metadata)
+        f.seek(file_weights)
+        f.write(image.tobytes())
+        f.seek(file_cmds)
+        f.write(cmds)
+
+
+class CompiledNetwork(object):
+    """ Network compiled by compile_network, loaded into one contiguous
+    arena with a bulk copy of the mapped file and a vectorized relocation
+    of the command addresses
+
+    run() packs an IFM volume into the input buffer, starts the IP once on
+    all commands and returns the unpacked output of the last layer. The
+    arena comes straight from the pool's backend, whose power of two size
+    classes would round it up """
+
+    def __init__(self, path, cnn, pool=None):
+        self.cnn = cnn
+        self.pool = pool if pool is not None else BufferPool()
+        mapped = np.memmap(path, dtype=np.uint8, mode='r')
+        (magic, version, metadata_length, arena_size, weights_offset,
+         weights_length, cmd_offset, num_commands, file_weights,
+         file_cmds) = COMPILED_HEADER.unpack_from(mapped)
+        if magic != COMPILED_MAGIC or version != COMPILED_VERSION:
+            raise ValueError("%s is not a compiled darius network" % path)
+        metadata = json.loads(bytes(mapped[COMPILED_HEADER.size:
+                                           COMPILED_HEADER.size +
+                                           metadata_length]))
+
+        self.arena = self.pool.backend.cma_array(arena_size, dtype=np.uint8)
+        base = self.arena.physical_address
+        np.copyto(self.arena[weights_offset:weights_offset + weights_length],
+                  mapped[file_weights:file_weights + weights_length])
+        cmd_length = num_commands * IP_CMD_LENGTH
+        cmds = self.arena[cmd_offset:cmd_offset + cmd_length]
+        np.copyto(cmds, mapped[file_cmds:file_cmds + cmd_length])
+        words = cmds.view(np.uint32).reshape(num_commands, -1)
+        words[:, CMD_ADDRESS_WORDS] += np.uint32(base)
+        self.arena.flush()
+        del mapped
+
+        self.num_commands = num_commands
+        self.cmd_baseaddr = base + cmd_offset
+        self.layers = [Darius(*[config[arg] for arg in DARIUS_ARGS], 0, 0, 0)
+                       for config in metadata['layers']]
+        # Only the input is flushed and the output invalidated per run
+        dtype = 'int%d' % C_MAX_INPUT_WIDTH
+        word = C_MAX_INPUT_WIDTH // 8
+        first, last = self.layers[0], self.layers[-1]
+        input_offset = metadata['input_offset']
+        output_offset = metadata['output_offset']
+        self.ifm = self.arena[input_offset:input_offset +
+                              first.ifm_packet_length * C_NUM_OF_ROWS *
+                              word].view(dtype)
+        self.ofm = self.arena[output_offset:output_offset +
+                              last.ofm_packet_length * C_NUM_OF_COLS *
+                              word].view(dtype)
+        self.hw_cycles = 0
+
+    def run(self, ifm_sw, **unpack_args):
+        """ Run the whole network on a row-major IFM volume and return the
+        row-major OFM volume of the last layer """
+        first, last = self.layers[0], self.layers[-1]
+        first.reshape_and_copy_ifm(ifm_sw, self.ifm)
+        self.ifm.flush()
+        if not IP_start(self.cnn, self.cmd_baseaddr, self.num_commands):
+            raise RuntimeError("CNNDataflow IP busy")
+        self.hw_cycles = IP_wait(self.cnn)
+        self.ofm.invalidate()
+        out = np.empty(last.ofm_shape(), dtype=self.ofm.dtype)
+        return last.unpack_ofm(self.ofm, out=out, **unpack_args)
+
+    def freebuffer(self):
+        self.arena.freebuffer()
@@ -30,6 +30,7 @@
 import numpy as np
 from math import *
 from random import *
+from .trace import traced
 
 __author__ = "Ehsan Ghasemi; Radhika Pokanati"
 __copyright__ = "Copyright 2016, Xilinx"
@@ -43,13 +44,145 @@ C_MAX_INPUT_WIDTH = 16
 C_NUM_OF_ROWS = 8
 C_NUM_OF_COLS = 8
 
+# CNNDataflow IP register map
+CNNDATAFLOW_BASEADDR = 0x43C00000
+CNNDATAFLOW_ADDR_RANGE = 0x10000
+NUM_COMMANDS_OFFSET = 0x60
+CMD_BASEADDR_OFFSET = 0x70
+CYCLE_COUNT_OFFSET = 0xd0
+IP_START = 0x1
+IP_STATE_IDLE = 0x4
+IP_STATE_DONE = 0x6
+
+# CNNDataflow IP command layout; every command is IP_CMD_LENGTH bytes
+IP_CMD_LENGTH = 128
+IP_CMD_CONV_FIELDS = ('ifm_height', 'ifm_width', 'kernel_height',
+                      'kernel_width', 'stride', 'pad', 'ofm_height',
+                      'ofm_width', 'ifm_slices', 'ofm_slices',
+                      'ofm_fragments', 'ifm_mem_fragments')
+IP_CMD_ADDR_FIELDS = ('ifm_baseaddr', 'ifm_packet_length', 'ifm_depth_offset',
+                      'ifm_height_offset', 'ofm_baseaddr',
+                      'ofm_packet_length', 'weights_baseaddr',
+                      'weights_packet_length', 'weight_depth_offset')
+IP_CMD_POOL_FIELDS = ('pool_input_height', 'pool_input_width',
+                      'pool_kernel_height', 'pool_kernel_width',
+                      'pool_output_height', 'pool_output_width',
+                      'pool_stride')
+
+
+def parse_IP_cmd(cmd, offset=0):
+    """ Decode one CNNDataflow IP command into a dict keyed by the Darius
+    attribute names the command was built from """
+    cmd = bytes(cmd[offset:offset + IP_CMD_LENGTH])
+    if len(cmd) != IP_CMD_LENGTH:
+        raise ValueError("CNNDataflow IP command has to be %d bytes"
+                         % IP_CMD_LENGTH)
+    fields = {}
+    values = np.frombuffer(cmd, dtype='uint16', count=12, offset=0)
+    fields.update(zip(IP_CMD_CONV_FIELDS, values.tolist()))
+    values = np.frombuffer(cmd, dtype='uint32', count=9, offset=24)
+    fields.update(zip(IP_CMD_ADDR_FIELDS, values.tolist()))
+    values = np.frombuffer(cmd, dtype='uint16', count=8, offset=64)
+    fields.update(zip(IP_CMD_POOL_FIELDS, values.tolist()))
+    return fields
+
+
+@traced('submit')
+def IP_start(cnn, cmd_baseaddr, num_commands=1):
+    """ Point the CNNDataflow IP at num_commands commands in physical memory
+    and start it; returns False if the IP is not idle """
+    cnn.write(NUM_COMMANDS_OFFSET, num_commands)
+    cnn.write(CMD_BASEADDR_OFFSET, cmd_baseaddr)
+    state = cnn.read(0x0)
+    if not state & IP_STATE_IDLE:
+        print("state %x: IP BUSY" % state)
+        return False
+    cnn.write(0x0, IP_START)
+    return True
+
+
+@traced('wait', hw_cycles=True)
+def IP_wait(cnn):
+    """ Poll the CNNDataflow IP until it is done and return its cycle count """
+    while cnn.read(0x0) != IP_STATE_DONE:
+        pass
+    return cnn.read(CYCLE_COUNT_OFFSET, 4)
+
+
+def _hw_view(buf, shape):
+    """ Return a view of the head of a flat physical memory buffer with the
+    given shape, so packed data is written in place """
+    count = 1
+    for dim in shape:
+        count *= dim
+    if not isinstance(buf, np.ndarray) or buf.ndim != 1 or \
+            not buf.flags.c_contiguous:
+        raise ValueError("Physical memory buffer has to be a flat contiguous "
+                         "array")
+    if buf.size < count:
+        raise ValueError("Physical memory buffer is too small: %d < %d"
+                         % (buf.size, count))
+    return buf[:count].reshape(shape)
+
+
+def _lane_ranges(size, lanes):
+    """ (first slice, last slice, lanes used) of the full slices and of the
+    partial last slice of size channels """
+    full, rest = divmod(size, lanes)
+    ranges = []
+    if full:
+        ranges.append((0, full, lanes))
+    if rest:
+        ranges.append((full, full + 1, rest))
+    return ranges
+
+
+def pack_slices(src, dst):
+    """ Copy a (depth, ...) volume into the (slices, ..., C_NUM_OF_ROWS)
+    hardware layout of dst, zero filling the lanes past depth """
+    for first, last, lanes in _lane_ranges(src.shape[0], C_NUM_OF_ROWS):
+        block = src[first * C_NUM_OF_ROWS:first * C_NUM_OF_ROWS +
+                    (last - first) * lanes]
+        block = block.reshape((last - first, lanes) + src.shape[1:])
+        np.copyto(dst[first:last, ..., :lanes], np.moveaxis(block, 1, -1),
+                  casting='unsafe')
+        if lanes < C_NUM_OF_ROWS:
+            dst[first:last, ..., lanes:] = 0
+
+
+def pack_weights(src, dst):
+    """ Copy (channels, depth, kernel_size) weights into the (ofm_slices,
+    ifm_slices, kernel_size, C_NUM_OF_ROWS, C_NUM_OF_COLS) hardware layout
+    of dst, zero filling the lanes past depth and channels """
+    channels, depth, kernel_size = src.shape
+    for ofm_first, ofm_last, cols in _lane_ranges(channels, C_NUM_OF_COLS):
+        for ifm_first, ifm_last, rows in _lane_ranges(depth, C_NUM_OF_ROWS):
+            block = src[ofm_first * C_NUM_OF_COLS:
+                        ofm_first * C_NUM_OF_COLS +
+                        (ofm_last - ofm_first) * cols,
+                        ifm_first * C_NUM_OF_ROWS:
+                        ifm_first * C_NUM_OF_ROWS +
+                        (ifm_last - ifm_first) * rows]
+            block = block.reshape(ofm_last - ofm_first, cols,
+                                  ifm_last - ifm_first, rows, kernel_size)
+            target = dst[ofm_first:ofm_last, ifm_first:ifm_last]
+            np.copyto(target[..., :rows, :cols],
+                      block.transpose(0, 2, 4, 3, 1), casting='unsafe')
+            if rows < C_NUM_OF_ROWS:
+                target[..., rows:, :] = 0
+            if cols < C_NUM_OF_COLS:
+                target[..., cols:] = 0
+
 
 class Darius(object):
     def __init__(self, ifm_height, ifm_width, ifm_depth, kernel_height,
                  kernel_width, pad, stride, channels,
                  pool_kernel_height, pool_kernel_width, pool_stride,
-                 ifm_baseaddr, weights_baseaddr, ofm_baseaddr):
-        """Return a new Convolution with Maxpool object"""
+                 ifm_baseaddr, weights_baseaddr, ofm_baseaddr,
+                 verbose=True):
+        """Return a new Convolution with Maxpool object; verbose=False
+        silences the INFO messages of the constructor and IP_cmd(), the
+        errors are still printed"""
 
         self.ifm_height = ifm_height
         self.ifm_width = ifm_width
@@ -65,6 +198,7 @@ class Darius(object):
         self.ifm_baseaddr = ifm_baseaddr
         self.weights_baseaddr = weights_baseaddr
         self.ofm_baseaddr = ofm_baseaddr
+        self.verbose = verbose
 
         def derive_attributes():
             self.ofm_height = ceil((self.ifm_height + 2 * self.pad - self.kernel_height) / self.stride + 1)
@@ -75,14 +209,16 @@ class Darius(object):
             self.ofm_fragments = 1
             self.ifm_mem_fragments = 1
         
+            # The hardware layout zero pads the IFM depth to full slices
+            self.ifm_hw_depth = self.ifm_slices * C_NUM_OF_ROWS
             self.ifm_packet_length = self.ifm_width * self.ifm_height * self.ifm_slices
-            self.ifm_depth_offset = self.ifm_width * self.ifm_height * self.ifm_depth
+            self.ifm_depth_offset = self.ifm_width * self.ifm_height * self.ifm_hw_depth
             self.ifm_height_offset = 0
             
             self.ofm_offset = self.ofm_height * self.ofm_width * self.ofm_depth
 
-            self.weights_packet_length = self.kernel_height * self.kernel_width * self.ifm_depth
-            self.weight_depth_offset = self.kernel_height * self.kernel_width * self.ifm_depth * \
+            self.weights_packet_length = self.kernel_height * self.kernel_width * self.ifm_hw_depth
+            self.weight_depth_offset = self.kernel_height * self.kernel_width * self.ifm_hw_depth * \
                               C_NUM_OF_COLS
             self.weight_offset = self.kernel_height * self.kernel_width * self.ifm_depth
             self.weight_pkt_offset = C_NUM_OF_ROWS * self.kernel_height * self.kernel_width
@@ -98,7 +234,8 @@ class Darius(object):
             except ZeroDivisionError:
                 self.pool_output_height = 0
                 self.pool_output_width = 0
-                print("INFO: POOL STRIDE OF 0 DISABLES MAXPOOLING; ONLY CONVOLUTION WOULD HAPPEN!")
+                if self.verbose:
+                    print("INFO: POOL STRIDE OF 0 DISABLES MAXPOOLING; ONLY CONVOLUTION WOULD HAPPEN!")
 
             # pool_stride has to be a multiple of 2
             if (self.pool_stride != 0 \
@@ -119,73 +256,84 @@ class Darius(object):
    
         derive_attributes()
 
-    def IP_cmd(self):        
-        """ Construct convolution command for CNNDataflow IP if the arguments
-        inputed are in supported range of Convolution Overlay """
+    def _IP_arg_error(self):
+        """ (error, tip) of the first argument outside the supported range
+        of the Convolution Overlay, or None; tip may be None """
 
         # The IFM demensions to be in range (6,32)
         if (self.ifm_height < 6 or self.ifm_width < 6 or self.ifm_height > 32 or self.ifm_width > 32):
-            print("ERROR: THE IFM VOLUME IS EITHER SMALLER/LARGER THAN SUPPORTED")
-            print("TIP: Make sure IFM height and width are in range from 6 to 32")
-            return False
+            return ("THE IFM VOLUME IS EITHER SMALLER/LARGER THAN SUPPORTED",
+                    "Make sure IFM height and width are in range from 6 to 32")
 
-        # The IFM depth to be multiples of 8 and are in range (8,1024)
-        if (self.ifm_depth <= 512 or self.ifm_depth >= 8):
-            if (self.ifm_depth % 8 != 0):
-                print("ERROR: THE IFM DEPTH NEEDS TO BE IN MULTIPLES OF 8 IN THE RANGE 8 TO 512")
-                return False
-        else:
-            print("ERROR: THE IFM DEPTH NEEDS TO BE IN MULTIPLES OF 8 IN THE RANGE 8 TO 512")
-            return False
+        # The IFM depth to be in range (1,512); the packers zero pad depths
+        # that are not multiples of 8 to full slices
+        if (self.ifm_depth < 1 or self.ifm_depth > 512):
+            return ("THE IFM DEPTH NEEDS TO BE IN THE RANGE 1 TO 512",
+                    "Split deeper IFM volumes with TiledLayer")
 
         # The Kernel demensions to be in range (1,16)
         if (self.kernel_height < 1 or self.kernel_width < 1 or self.kernel_height > 16 or self.kernel_width > 16):
-            print("ERROR: THE KERNEL DIMENSIONS ARE EITHER SMALLER/LARGER THAN SUPPORTED")
-            print("TIP: Make sure Kernel height and width are in range from 1 to 16")
-            return False
+            return ("THE KERNEL DIMENSIONS ARE EITHER SMALLER/LARGER THAN SUPPORTED",
+                    "Make sure Kernel height and width are in range from 1 to 16")
 
         if (self.stride > 4 or self.stride == 0 or (self.stride != 1 and self.stride % 2 != 0)):
-            print("ERROR: THIS STRIDE FOR CONVOLUTION IS NOT RECOMMENDED")
-            print("TIP: Make sure stride is either 1, 2 and 4")
-            return False
+            return ("THIS STRIDE FOR CONVOLUTION IS NOT RECOMMENDED",
+                    "Make sure stride is either 1, 2 and 4")
 
         # The Number of Pad bits to be in range (0,16)
         if (self.pad < 0 or self.pad > 16):
-            print("ERROR: THE PADDED BITS ARE EITHER SMALLER/LARGER THAN SUPPORTED")
-            print("TIP: Make sure Pad is in range from 0 to 16")
-            return False
+            return ("THE PADDED BITS ARE EITHER SMALLER/LARGER THAN SUPPORTED",
+                    "Make sure Pad is in range from 0 to 16")
 
         # The OFM Channels to be multiples of 8 and are in range (8,1024)
         if (self.ofm_depth <= 512 or self.ofm_depth >= 8):
             if (self.ofm_depth % 8 != 0):
-                print("ERROR: THE NUMBER OF CHANNELS NEEDS TO BE IN MULTIPLES OF 8 IN THE RANGE 8 TO 512")
-                return False
+                return ("THE NUMBER OF CHANNELS NEEDS TO BE IN MULTIPLES OF 8 IN THE RANGE 8 TO 512",
+                        None)
         else:
-            print("ERROR: THE NUMBER OF CHANNELS NEEDS TO BE IN MULTIPLES OF 8 IN THE RANGE 8 TO 512")
-            return False
+            return ("THE NUMBER OF CHANNELS NEEDS TO BE IN MULTIPLES OF 8 IN THE RANGE 8 TO 512",
+                    None)
 
         # The accumulation loopback has 10 cycle delay
         if (self.ofm_height * self.ofm_width < 10):
-            print("ERROR: THE OFM VOLUME IS SMALLER THAN SUPPORTED")
-            print("TIP: Manage the IFM dimensions, kernel dimensions and other "
-                  "arguments such that ofm volume is of moderate size ")
-            return False
+            return ("THE OFM VOLUME IS SMALLER THAN SUPPORTED",
+                    "Manage the IFM dimensions, kernel dimensions and other "
+                    "arguments such that ofm volume is of moderate size ")
 
         # The 2D dimensions are limited by BRAM chosen
         if (self.ifm_height * self.ifm_width > (1 << C_MAX_ADDR_WIDTH) or self.ofm_height * self.ofm_width > (1 << C_MAX_ADDR_WIDTH)):
-            print("ERROR: THE IFM/OFM PLANE DOES NOT FIT IN THE LINE BUFFER")
-            return False
+            return ("THE IFM/OFM PLANE DOES NOT FIT IN THE LINE BUFFER",
+                    None)
 
         # The max allowable block read (BTT) by the datamover is limited by
         # 2^23. The num of channels is currently limited by this number
         if (self.ofm_height * self.ofm_width * self.channels * (C_MAX_INPUT_WIDTH / 8) > 1 << 23):
-            print("ERROR: THE NUMBER OF CHANNELS IS LARGER THAN THE MAXIMUM "
-                  "ALLOWABLE BYTES-TO-TRANSFER(BTT) OF DATAMOVER")
-            print("TIP: Decrease the number of channels")
+            return ("THE NUMBER OF CHANNELS IS LARGER THAN THE MAXIMUM "
+                    "ALLOWABLE BYTES-TO-TRANSFER(BTT) OF DATAMOVER",
+                    "Decrease the number of channels")
+        return None
+
+    def unsupported_reason(self):
+        """ Why the CNNDataflow IP can not run this layer, or None when all
+        IP arguments are in supported range """
+        error = self._IP_arg_error()
+        return None if error is None else error[0]
+
+    @traced('build_cmd')
+    def IP_cmd(self):        
+        """ Construct convolution command for CNNDataflow IP if the arguments
+        inputed are in supported range of Convolution Overlay """
+
+        error = self._IP_arg_error()
+        if error is not None:
+            print("ERROR: " + error[0])
+            if error[1] is not None:
+                print("TIP: " + error[1])
             return False
 
         while True:
-            print("All IP arguments are in supported range")
+            if self.verbose:
+                print("All IP arguments are in supported range")
             cmd_conv = np.array([self.ifm_height, self.ifm_width, self.kernel_height,
                                  self.kernel_width, self.stride, self.pad, self.ofm_height,
                                  self.ofm_width, self.ifm_slices, self.ofm_slices,
@@ -217,9 +365,113 @@ class Darius(object):
             return IP_cmd
             break
 
+    @traced('pack_ifm')
     def reshape_and_copy_ifm(self, ifm_sw, ifm):
         """ Reshape the IFM Volume as per IP requirement and copy to physical
         memory with ifm pointer """
+        plane = self.ifm_height * self.ifm_width
+        src = np.asarray(ifm_sw)[:self.ifm_depth * plane]
+        dst = _hw_view(ifm, (self.ifm_slices, plane, C_NUM_OF_ROWS))
+        pack_slices(src.reshape(self.ifm_depth, plane), dst)
+
+    @traced('pack_weights')
+    def reshape_and_copy_weights(self, weights_sw, weights):
+        """ Reshape the Weights as per IP requirement and copy to physical
+        memory with weights pointer """
+        kernel_size = self.kernel_height * self.kernel_width
+        src = np.asarray(weights_sw)[:self.channels * self.weight_offset]
+        dst = _hw_view(weights, (self.ofm_slices, self.ifm_slices, kernel_size,
+                                 C_NUM_OF_ROWS, C_NUM_OF_COLS))
+        pack_weights(src.reshape(self.channels, self.ifm_depth, kernel_size),
+                     dst)
+
+    def ofm_shape(self):
+        """ Shape (channels, height, width) of the OFM volume written by the
+        IP, which has the maxpool dimensions when pooling is enabled """
+        if self.pool_stride != 0:
+            return (self.ofm_depth, self.pool_output_height,
+                    self.pool_output_width)
+        return (self.ofm_depth, self.ofm_height, self.ofm_width)
+
+    @traced('unpack')
+    def unpack_ofm(self, ofm, out=None, bias=None, relu=False, shift=None):
+        """ Reshape the OFM Volume written by the IP back to a row-major
+        (channels, height, width) volume
+
+        A per channel bias, an arithmetic right shift and a ReLU can be fused
+        into the copy; they are applied in that order, one OFM slice at a
+        time, and integer results saturate to the range of the out dtype.
+        A negative shift scales float outputs up and raises a ValueError
+        for integer ones. Without post-ops and output buffer, a layer with
+        a single OFM slice returns a view of the physical memory instead of
+        a copy """
+        channels, height, width = self.ofm_shape()
+        hw = _hw_view(ofm, (self.ofm_slices, height, width, C_NUM_OF_COLS))
+        hw = hw.transpose(0, 3, 1, 2)
+        post_ops = bias is not None or relu or shift is not None
+
+        if out is None:
+            if self.ofm_slices == 1 and not post_ops:
+                return hw[0, :channels]
+            out = np.empty((channels, height, width), dtype=hw.dtype)
+        elif out.shape != (channels, height, width):
+            raise ValueError("OFM output buffer has shape %s, expected %s"
+                             % (out.shape, (channels, height, width)))
+
+        if not post_ops:
+            for i in range(self.ofm_slices):
+                first = i * C_NUM_OF_COLS
+                last = min(first + C_NUM_OF_COLS, channels)
+                np.copyto(out[first:last], hw[i, :last - first],
+                          casting='unsafe')
+            return out
+
+        integer = np.issubdtype(out.dtype, np.integer)
+        if integer:
+            work_dtype = np.int64 if out.dtype.itemsize > 4 else np.int32
+            lower = np.iinfo(out.dtype).min
+            upper = np.iinfo(out.dtype).max
+            if relu:
+                lower = max(lower, 0)
+        else:
+            work_dtype = out.dtype
+        if bias is not None:
+            bias = np.broadcast_to(np.asarray(bias), (channels,))
+            bias = bias.reshape(channels, 1, 1)
+        if shift is not None:
+            shift = np.broadcast_to(np.asarray(shift), (channels,))
+            if integer and (shift < 0).any():
+                raise ValueError("Negative shifts are not supported for "
+                                 "integer outputs")
+            shift = shift.reshape(channels, 1, 1)
+        scratch = np.empty((C_NUM_OF_COLS, height, width), dtype=work_dtype)
+
+        for i in range(self.ofm_slices):
+            first = i * C_NUM_OF_COLS
+            last = min(first + C_NUM_OF_COLS, channels)
+            acc = scratch[:last - first]
+            if bias is not None:
+                np.add(hw[i, :last - first], bias[first:last], out=acc,
+                       casting='unsafe')
+            else:
+                np.copyto(acc, hw[i, :last - first], casting='unsafe')
+            if shift is not None:
+                if integer:
+                    np.right_shift(acc, shift[first:last], out=acc,
+                                   casting='unsafe')
+                else:
+                    np.ldexp(acc, -shift[first:last], out=acc)
+            if integer:
+                np.clip(acc, lower, upper, out=out[first:last],
+                        casting='unsafe')
+            elif relu:
+                np.maximum(acc, 0, out=out[first:last])
+            else:
+                out[first:last] = acc
+        return out
+
+    def reshape_and_copy_ifm_ref(self, ifm_sw, ifm):
+        """ Element by element reference for reshape_and_copy_ifm """
         hw_index = 0
         for i in range(0, self.ifm_slices):
             for j in range(0, self.ifm_height * self.ifm_width):
@@ -229,9 +481,8 @@ class Darius(object):
                     ifm[hw_index] = ifm_sw[index]
                     hw_index = hw_index + 1
 
-    def reshape_and_copy_weights(self, weights_sw, weights):
-        """ Reshape the Weights as per IP requirement and copy to physical
-        memory with weights pointer """
+    def reshape_and_copy_weights_ref(self, weights_sw, weights):
+        """ Element by element reference for reshape_and_copy_weights """
         weights_index = 0
         for i in range(0, self.ofm_slices):
             for j in range(0, self.ifm_slices):
@@ -0,0 +1,300 @@
+#   Copyright (c) 2018, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import asyncio
+import copy
+import queue
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures import Future
+import numpy as np
+from .darius_lib import IP_CMD_LENGTH, IP_STATE_DONE, CYCLE_COUNT_OFFSET
+from .darius_lib import IP_start
+from .buffer_pool import BufferPool
+from .trace import traced
+
+__author__ = ""
+__copyright__ = "Copyright 2018, Xilinx"
+__email__ = "pynq_support@xilinx.com"
+
+
+def _busy_overlap(first, second):
+    """ Total time two lists of sorted (start, end) intervals overlap """
+    total = 0.0
+    i = j = 0
+    while i < len(first) and j < len(second):
+        start = max(first[i][0], second[j][0])
+        end = min(first[i][1], second[j][1])
+        if end > start:
+            total += end - start
+        if first[i][1] < second[j][1]:
+            i += 1
+        else:
+            j += 1
+    return total
+
+
+class _BufferSet(object):
+    """ Command, IFM and OFM buffers of one request in flight """
+
+    def __init__(self, pool, index, ifm_size, ofm_size):
+        self.index = index
+        self.cmd = pool.allocate(IP_CMD_LENGTH, np.uint8)
+        self.ifm = pool.allocate(ifm_size, np.int16)
+        self.ofm = pool.allocate(ofm_size, np.int16)
+        self.request = None
+
+    def freebuffer(self):
+        for buf in (self.cmd, self.ifm, self.ofm):
+            buf.freebuffer()
+
+
+class Executor(object):
+    """ Asynchronous front end of the CNNDataflow IP
+
+    submit(layer, ifm_sw) returns a Future of the unpacked OFM. A packer
+    thread writes request N+1 into a free buffer set while the IP runs
+    request N, and the device thread starts the next packed request as soon
+    as the IP is done, before unpacking the finished one. The weights of a
+    layer have to be packed at its weights_baseaddr beforehand; the IFM and
+    OFM addresses of the layer are replaced by those of the buffer set.
+
+    Completion is detected by polling the state register with exponential
+    backoff from min_poll to max_poll seconds, or by waiting on interrupt,
+    an object with a wait() method or coroutine that returns once the IP is
+    done. A coroutine, such as the one of pynq.Interrupt, is run on loop,
+    the running event loop it is bound to. Buffers come from pool, which
+    defaults to a BufferPool on Xlnk """
+
+    def __init__(self, cnn, pool=None, ifm_size=1 << 20, ofm_size=1 << 20,
+                 buffer_sets=2, max_queue=16, interrupt=None, loop=None,
+                 min_poll=1e-5, max_poll=1e-3):
+        if interrupt is not None and loop is None and \
+                asyncio.iscoroutinefunction(interrupt.wait):
+            raise ValueError("A coroutine interrupt needs the event loop it "
+                             "is bound to")
+        self.cnn = cnn
+        self.pool = pool if pool is not None else BufferPool()
+        self.interrupt = interrupt
+        self.loop = loop
+        self.min_poll = min_poll
+        self.max_poll = max_poll
+        self._sets = [_BufferSet(self.pool, i, ifm_size, ofm_size)
+                      for i in range(buffer_sets)]
+        self._free_sets = queue.Queue()
+        for buffer_set in self._sets:
+            self._free_sets.put(buffer_set)
+        self._requests = queue.Queue(max_queue)
+        self._ready = queue.Queue()
+        self._cmds = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._stopping = False
+        self.max_queue_depth = 0
+        self.completed = 0
+        self.hw_cycles = 0
+        self._pack_busy = deque(maxlen=4096)
+        self._device_busy = deque(maxlen=4096)
+        self._packer = threading.Thread(target=self._pack_loop, daemon=True)
+        self._device = threading.Thread(target=self._device_loop,
+                                        daemon=True)
+        self._packer.start()
+        self._device.start()
+
+    def submit(self, layer, ifm_sw, **unpack_args):
+        """ Queue one IFM volume for layer; returns a Future of the OFM
+        volume, unpacked with Darius.unpack_ofm(**unpack_args) """
+        future = Future()
+        with self._lock:
+            self._pending += 1
+            self.max_queue_depth = max(self.max_queue_depth, self._pending)
+        self._requests.put((layer, ifm_sw, unpack_args, future))
+        return future
+
+    async def submit_async(self, layer, ifm_sw, **unpack_args):
+        """ asyncio variant of submit() """
+        return await asyncio.wrap_future(
+            self.submit(layer, ifm_sw, **unpack_args))
+
+    def map(self, layer, ifms, **unpack_args):
+        """ Run layer on every IFM volume, keeping the pipeline full """
+        futures = [self.submit(layer, ifm_sw, **unpack_args)
+                   for ifm_sw in ifms]
+        return [future.result() for future in futures]
+
+    @property
+    def queue_depth(self):
+        """ Requests submitted and not completed yet """
+        return self._pending
+
+    def stats(self):
+        """ Queue depth, completions and the share of the packing time that
+        overlapped with the IP running """
+        pack_busy = list(self._pack_busy)
+        device_busy = list(self._device_busy)
+        pack_time = sum(end - start for start, end in pack_busy)
+        device_time = sum(end - start for start, end in device_busy)
+        overlap = _busy_overlap(pack_busy, device_busy)
+        return {'queue_depth': self.queue_depth,
+                'max_queue_depth': self.max_queue_depth,
+                'completed': self.completed,
+                'hw_cycles': self.hw_cycles,
+                'pack_time': pack_time,
+                'device_time': device_time,
+                'overlap_percent': 100.0 * overlap / pack_time
+                if pack_time else 0.0}
+
+    def shutdown(self):
+        """ Finish the queued requests and release the buffers """
+        self._requests.put(None)
+        self._packer.join()
+        self._device.join()
+        for buffer_set in self._sets:
+            buffer_set.freebuffer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def _cmd(self, layer, buffer_set):
+        """ Command of layer on the buffers of a set, built once per
+        weights address; the cache entries go with the layer """
+        cmds = self._cmds.setdefault(layer, {})
+        cached = cmds.get(buffer_set.index)
+        if cached is None or cached[0] != layer.weights_baseaddr:
+            hw_layer = copy.copy(layer)
+            hw_layer.ifm_baseaddr = buffer_set.ifm.physical_address
+            hw_layer.ofm_baseaddr = buffer_set.ofm.physical_address
+            cached = (layer.weights_baseaddr, hw_layer.IP_cmd())
+            cmds[buffer_set.index] = cached
+        return cached[1]
+
+    def _pack_loop(self):
+        while True:
+            request = self._requests.get()
+            if request is None:
+                self._ready.put(None)
+                return
+            layer, ifm_sw, unpack_args, future = request
+            buffer_set = self._free_sets.get()
+            started = time.perf_counter()
+            try:
+                cmd = self._cmd(layer, buffer_set)
+                if cmd is False:
+                    raise ValueError("Layer is not supported by the "
+                                     "CNNDataflow IP")
+                layer.reshape_and_copy_ifm(ifm_sw, buffer_set.ifm)
+                buffer_set.cmd[:len(cmd)] = np.frombuffer(cmd, np.uint8)
+                buffer_set.cmd.flush()
+                buffer_set.ifm.flush()
+            except Exception as e:
+                self._finish(buffer_set, future, exception=e)
+                continue
+            self._pack_busy.append((started, time.perf_counter()))
+            buffer_set.request = (layer, unpack_args, future)
+            self._ready.put(buffer_set)
+
+    def _device_loop(self):
+        running = self._start_next(block=True)
+        while running is not None:
+            buffer_set, started = running
+            try:
+                cycles = self._wait()
+            except Exception as e:
+                self._finish(buffer_set, buffer_set.request[2], exception=e)
+                running = self._start_next(block=not self._stopping)
+                continue
+            self._device_busy.append((started, time.perf_counter()))
+            # Keep the IP busy with the next packed request while this one
+            # is unpacked
+            running = self._start_next(block=False)
+            self._complete(buffer_set, cycles)
+            if running is None and not self._stopping:
+                running = self._start_next(block=True)
+
+    def _start_next(self, block):
+        """ Start the IP on the next packed buffer set; returns the set and
+        its start time, or None if there is none (yet) """
+        while True:
+            try:
+                buffer_set = self._ready.get(block)
+            except queue.Empty:
+                return None
+            if buffer_set is None:
+                self._stopping = True
+                return None
+            started = time.perf_counter()
+            if IP_start(self.cnn, buffer_set.cmd.physical_address):
+                return buffer_set, started
+            self._finish(buffer_set, buffer_set.request[2],
+                         exception=RuntimeError("CNNDataflow IP busy"))
+
+    def _complete(self, buffer_set, cycles):
+        """ Unpack the OFM of a finished request and resolve its future """
+        layer, unpack_args, future = buffer_set.request
+        try:
+            buffer_set.ofm.invalidate()
+            out = np.empty(layer.ofm_shape(), dtype=buffer_set.ofm.dtype)
+            result = layer.unpack_ofm(buffer_set.ofm, out=out, **unpack_args)
+        except Exception as e:
+            self._finish(buffer_set, future, exception=e)
+        else:
+            self.hw_cycles += cycles
+            self._finish(buffer_set, future, result=result)
+
+    @traced('wait', hw_cycles=True)
+    def _wait(self):
+        """ Wait for the IP to be done and return its cycle count """
+        if self.interrupt is not None:
+            if asyncio.iscoroutinefunction(self.interrupt.wait):
+                asyncio.run_coroutine_threadsafe(self.interrupt.wait(),
+                                                 self.loop).result()
+            else:
+                self.interrupt.wait()
+        delay = self.min_poll
+        while self.cnn.read(0x0) != IP_STATE_DONE:
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_poll)
+        return self.cnn.read(CYCLE_COUNT_OFFSET, 4)
+
+    def _finish(self, buffer_set, future, result=None, exception=None):
+        buffer_set.request = None
+        self._free_sets.put(buffer_set)
+        with self._lock:
+            self._pending -= 1
+            self.completed += 1
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
@@ -0,0 +1,215 @@
+#   Copyright (c) 2018, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import copy
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
+from .darius_lib import C_MAX_INPUT_WIDTH
+from .reference import C_ACCUM_WIDTH, _wrap, conv2d_hwc, maxpool_hwc
+
+__author__ = ""
+__copyright__ = "Copyright 2018, Xilinx"
+__email__ = "pynq_support@xilinx.com"
+
+FPGA = 'fpga'
+CPU = 'cpu'
+
+
+def cpu_conv(layer, ifm_sw, weights_sw, threads=None, bands=1):
+    """ Convolution with Maxpool of a Darius layer on the CPU, with the
+    arithmetic of the CNNDataflow IP, for any layer the IP rejects
+
+    The output rows are split into bands bands computed with im2col and
+    BLAS, in parallel on the threads of threads, a ThreadPoolExecutor, if
+    one is given. Returns the row-major (channels, height, width) int16
+    OFM volume """
+    ifm = np.asarray(ifm_sw).reshape(layer.ifm_depth, layer.ifm_height,
+                                     layer.ifm_width).transpose(1, 2, 0)
+    weights = np.asarray(weights_sw).reshape(
+        layer.channels, layer.ifm_depth, layer.kernel_height,
+        layer.kernel_width).transpose(2, 3, 1, 0)
+    pad = layer.pad
+    padded = np.zeros((layer.ifm_height + 2 * pad, layer.ifm_width + 2 * pad,
+                       layer.ifm_depth), dtype=ifm.dtype)
+    padded[pad:pad + layer.ifm_height, pad:pad + layer.ifm_width] = ifm
+    result = np.empty((layer.ofm_height, layer.ofm_width, layer.channels),
+                      dtype='int%d' % C_MAX_INPUT_WIDTH)
+
+    def band(first, last):
+        rows = padded[first * layer.stride:
+                      (last - 1) * layer.stride + layer.kernel_height]
+        acc = conv2d_hwc(rows, weights, layer.stride, 0, last - first,
+                         layer.ofm_width)
+        np.copyto(result[first:last],
+                  _wrap(_wrap(acc, C_ACCUM_WIDTH), C_MAX_INPUT_WIDTH),
+                  casting='unsafe')
+
+    bands = 1 if threads is None else max(min(bands, layer.ofm_height), 1)
+    edges = np.linspace(0, layer.ofm_height, bands + 1).astype(int)
+    if bands == 1:
+        band(0, layer.ofm_height)
+    else:
+        for future in [threads.submit(band, first, last)
+                       for first, last in zip(edges[:-1], edges[1:])]:
+            future.result()
+
+    if layer.pool_stride != 0:
+        result = maxpool_hwc(result, layer.pool_kernel_height,
+                             layer.pool_kernel_width, layer.pool_stride,
+                             layer.pool_output_height,
+                             layer.pool_output_width)
+    return np.ascontiguousarray(result.transpose(2, 0, 1))
+
+
+class HybridExecutor(object):
+    """ Runs a network of Darius layers on the CNNDataflow IP and the CPU
+
+    Every layer whose IP_cmd() the IP accepts runs on fpga, an object with
+    the run(layer, ifm_sw) interface of the Convolution overlay, with its
+    weights packed once at start up; the others run on cpu_conv tiled over
+    a pool of threads. Each device works through its layers in order on
+    its own thread, so the FPGA layers of one request run while the CPU
+    works on another. Without fpga every layer runs on the CPU.
+
+    report() gives where each layer ran, why, and how long it took """
+
+    def __init__(self, layers, weights, fpga=None, threads=None):
+        self.fpga = fpga
+        self.layers = []
+        self.placement = []
+        self._weights = []
+        self._packed = []
+        for layer, layer_weights in zip(layers, weights):
+            device, reason = self._place(layer)
+            if device == FPGA:
+                packed = fpga.pool.allocate(
+                    layer.weight_depth_offset * layer.ofm_slices, np.int16)
+                layer.reshape_and_copy_weights(layer_weights, packed)
+                packed.flush()
+                self._packed.append(packed)
+                layer = copy.copy(layer)
+                layer.weights_baseaddr = packed.physical_address
+            self.layers.append(layer)
+            self._weights.append(layer_weights)
+            self.placement.append((device, reason))
+
+        self.num_threads = threads or os.cpu_count() or 1
+        self.threads = ThreadPoolExecutor(self.num_threads)
+        self._devices = {FPGA: ThreadPoolExecutor(1),
+                         CPU: ThreadPoolExecutor(1)}
+        self._lock = threading.Lock()
+        self._times = [[] for _ in self.layers]
+
+    def _place(self, layer):
+        """ (device, reason) of a layer, with the reason the IP rejects it """
+        if self.fpga is None:
+            return CPU, "no FPGA"
+        reason = layer.unsupported_reason()
+        if reason is None:
+            return FPGA, ""
+        return CPU, reason
+
+    def _run_layer(self, index, ifm_sw):
+        layer = self.layers[index]
+        start = time.perf_counter()
+        if self.placement[index][0] == FPGA:
+            ofm = self.fpga.run(layer, ifm_sw)
+        else:
+            ofm = cpu_conv(layer, ifm_sw, self._weights[index], self.threads,
+                           self.num_threads)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._times[index].append(elapsed)
+        return ofm
+
+    def _next(self, future, index, ifm_sw):
+        """ Queue layer index of a request on its device, and the layer
+        after it when it is done """
+        if index == len(self.layers):
+            future.set_result(ifm_sw)
+            return
+        device = self._devices[self.placement[index][0]]
+        step = device.submit(self._run_layer, index, ifm_sw)
+
+        def done(step):
+            error = step.exception()
+            if error is not None:
+                future.set_exception(error)
+            else:
+                self._next(future, index + 1, step.result())
+        step.add_done_callback(done)
+
+    def submit(self, ifm_sw):
+        """ Run the network on a row-major IFM volume; returns a Future of
+        the row-major OFM volume of the last layer """
+        future = Future()
+        self._next(future, 0, ifm_sw)
+        return future
+
+    def run(self, ifm_sw):
+        return self.submit(ifm_sw).result()
+
+    def map(self, ifms):
+        """ Run the network on several IFM volumes, overlapping the two
+        devices, and return the OFMs in order """
+        return [future.result() for future in
+                [self.submit(ifm_sw) for ifm_sw in ifms]]
+
+    def report(self):
+        """ Placement of every layer: index, device, reason for running on
+        the CPU, number of runs and total and mean time in seconds """
+        with self._lock:
+            times = [list(layer_times) for layer_times in self._times]
+        return [{'layer': index,
+                 'device': device,
+                 'reason': reason,
+                 'runs': len(layer_times),
+                 'total_time': sum(layer_times),
+                 'mean_time': sum(layer_times) / len(layer_times)
+                 if layer_times else 0.0}
+                for index, ((device, reason), layer_times)
+                in enumerate(zip(self.placement, times))]
+
+    def shutdown(self):
+        for device in self._devices.values():
+            device.shutdown()
+        self.threads.shutdown()
+        for packed in self._packed:
+            packed.freebuffer()
+        self._packed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
@@ -0,0 +1,331 @@
+#   Copyright (c) 2018, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import io
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from .darius_lib import C_NUM_OF_ROWS
+from .buffer_pool import BufferPool
+from .packed import PackedTensor
+from .quantize import quantize_array
+from .trace import traced
+
+__author__ = ""
+__copyright__ = "Copyright 2018, Xilinx"
+__email__ = "pynq_support@xilinx.com"
+
+INGEST_STAGES = ('decode', 'resize', 'pack')
+INGEST_POLL_SECONDS = 0.05
+
+
+def decode_image(item):
+    """ (rows, cols, 3) uint8 array of an image file path, encoded bytes
+    or an array, which is passed through """
+    if isinstance(item, np.ndarray):
+        return item
+    from PIL import Image
+    if isinstance(item, (bytes, bytearray)):
+        item = io.BytesIO(item)
+    with Image.open(item) as image:
+        return np.asarray(image.convert('RGB'))
+
+
+@traced('pack_ifm')
+def pack_hwc(image, tensor, bits=0):
+    """ Write a (rows, cols, depth) image into a PackedTensor in the IFM
+    layout, scaled by 2**bits and saturated to 16 bits, without a CHW copy;
+    the lanes past depth are zero filled """
+    if image.shape != (tensor.height, tensor.width, tensor.channels):
+        raise ValueError("Image of shape %s does not match the tensor of "
+                         "shape %s" % (image.shape, (tensor.height,
+                                                     tensor.width,
+                                                     tensor.channels)))
+    hw = tensor.hw
+    depth = image.shape[2]
+    for i in range(tensor.slices):
+        lanes = min(depth - i * C_NUM_OF_ROWS, C_NUM_OF_ROWS)
+        target = hw[i, ..., :lanes]
+        source = image[..., i * C_NUM_OF_ROWS:i * C_NUM_OF_ROWS + lanes]
+        if bits:
+            np.copyto(target, quantize_array(source, bits), casting='unsafe')
+        else:
+            np.copyto(target, source, casting='unsafe')
+        if lanes < C_NUM_OF_ROWS:
+            hw[i, ..., lanes:] = 0
+
+
+class _StageStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = 0
+        self.busy = 0.0
+        self.blocked = 0.0
+
+    def add(self, busy, blocked=0.0):
+        with self.lock:
+            self.items += 1
+            self.busy += busy
+            self.blocked += blocked
+
+
+class _Failure(object):
+    def __init__(self, error):
+        self.error = error
+
+
+class IngestPipeline(object):
+    """ Threaded decode, resize, quantize and pack of images into the IFM
+    buffers of a Darius layer
+
+    Images are decoded by decode_threads threads, resized in order to the
+    layer's IFM plane by resizer (a Resizer or SoftwareResizer of the
+    resize package; without it the images have to be of that size), and
+    written straight from HWC uint8 into PackedTensor IFMs, scaled by
+    2**bits. run() raises a ValueError for an image whose depth is not the
+    layer's IFM depth. The stages are connected by queues of queue_size
+    items and the IFMs come from a fixed set of buffers, so a slow consumer
+    stalls the stages instead of filling memory. IFMs are yielded by run() in input
+    order and returned with release() once the accelerator is done with
+    them; they can be passed to Convolution.run_packed as they are """
+
+    def __init__(self, layer, resizer=None, pool=None, decode=decode_image,
+                 decode_threads=4, buffers=4, queue_size=8, bits=0):
+        self.layer = layer
+        self.resizer = resizer
+        self.pool = pool if pool is not None else BufferPool()
+        self.decode = decode
+        self.decode_threads = decode_threads
+        self.queue_size = queue_size
+        self.bits = bits
+        self._tensors = [PackedTensor.allocate(self.pool, layer.ifm_depth,
+                                               layer.ifm_height,
+                                               layer.ifm_width)
+                         for _ in range(buffers)]
+        self._free = queue.Queue()
+        for tensor in self._tensors:
+            self._free.put(tensor)
+        self._stats = {stage: _StageStats() for stage in INGEST_STAGES}
+        self._started = None
+        self._elapsed = 0.0
+        self._queues = ()
+        self._stop = threading.Event()
+
+    def release(self, tensor):
+        """ Return an IFM yielded by run() for reuse """
+        self._free.put(tensor)
+
+    def _put(self, q, item):
+        """ Put item on q unless the pipeline is stopped first; False if it
+        is """
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=INGEST_POLL_SECONDS)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        """ Next item of q, or None once the pipeline is stopped """
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=INGEST_POLL_SECONDS)
+            except queue.Empty:
+                pass
+        return None
+
+    def _decode(self, item):
+        start = time.perf_counter()
+        image = self.decode(item)
+        self._stats['decode'].add(time.perf_counter() - start)
+        return image
+
+    def _feed(self, items, decoder, decoded):
+        try:
+            for item in items:
+                if self._stop.is_set():
+                    return
+                future = decoder.submit(self._decode, item)
+                if not self._put(decoded, future):
+                    future.cancel()
+                    return
+        except Exception as e:
+            self._put(decoded, _Failure(e))
+        self._put(decoded, None)
+
+    def _images(self, decoded, waited):
+        """ Decoded images in input order; the time spent waiting for them
+        is added to waited[0] """
+        while True:
+            start = time.perf_counter()
+            future = self._get(decoded)
+            if future is None:
+                return
+            if isinstance(future, _Failure):
+                raise future.error
+            image = future.result()
+            waited[0] += time.perf_counter() - start
+            yield image
+
+    def _resize(self, decoded, resized):
+        shape = (self.layer.ifm_height, self.layer.ifm_width,
+                 self.layer.ifm_depth)
+        stats = self._stats['resize']
+        waited = [0.0]
+        images = self._images(decoded, waited)
+        if self.resizer is not None:
+            images = self.resizer.resize_stream(images, shape[:2])
+        try:
+            start = time.perf_counter()
+            for image in images:
+                if image.shape != shape:
+                    raise ValueError("Image of shape %s does not match the "
+                                     "(rows, cols, depth) %s of the layer's "
+                                     "IFM" % (image.shape, shape))
+                blocked = time.perf_counter()
+                if not self._put(resized, image):
+                    return
+                busy = blocked - start - waited[0]
+                start, waited[0] = time.perf_counter(), 0.0
+                stats.add(busy, start - blocked)
+        except Exception as e:
+            self._put(resized, _Failure(e))
+        finally:
+            # Lets a resizer wait for the frames it has in flight
+            images.close()
+        self._put(resized, None)
+
+    def _pack(self, resized, ready):
+        stats = self._stats['pack']
+        while True:
+            image = self._get(resized)
+            if image is None or isinstance(image, _Failure):
+                self._put(ready, image)
+                return
+            blocked = time.perf_counter()
+            tensor = self._get(self._free)
+            if tensor is None:
+                return
+            start = time.perf_counter()
+            try:
+                pack_hwc(image, tensor, self.bits)
+                tensor.flush()
+            except Exception as e:
+                self._free.put(tensor)
+                self._put(ready, _Failure(e))
+                return
+            stats.add(time.perf_counter() - start, start - blocked)
+            if not self._put(ready, tensor):
+                self._free.put(tensor)
+                return
+
+    def run(self, items):
+        """ Generator of the packed IFMs of an iterable of images
+
+        When the generator is closed early, or raises, the stages are
+        stopped, the decodes not yet started cancelled and the IFMs packed
+        but not yielded returned to the free buffers """
+        decoded = queue.Queue(self.queue_size)
+        resized = queue.Queue(self.queue_size)
+        ready = queue.Queue(self.queue_size)
+        self._queues = (decoded, resized, ready)
+        self._stop.clear()
+        self._started = time.perf_counter()
+        decoder = ThreadPoolExecutor(self.decode_threads)
+        threads = [
+            threading.Thread(target=self._feed,
+                             args=(items, decoder, decoded), daemon=True),
+            threading.Thread(target=self._resize,
+                             args=(decoded, resized), daemon=True),
+            threading.Thread(target=self._pack, args=(resized, ready),
+                             daemon=True)]
+        try:
+            for thread in threads:
+                thread.start()
+            while True:
+                tensor = ready.get()
+                if tensor is None:
+                    break
+                if isinstance(tensor, _Failure):
+                    raise tensor.error
+                yield tensor
+        finally:
+            self._stop.set()
+            for thread in threads:
+                if thread.is_alive():
+                    thread.join()
+            self._drain(decoded, resized, ready)
+            decoder.shutdown(wait=True)
+            self._elapsed += time.perf_counter() - self._started
+            self._started = None
+
+    def _drain(self, decoded, resized, ready):
+        """ Empty the queues of stopped stages """
+        for q in (decoded, resized, ready):
+            while True:
+                try:
+                    item = q.get_nowait()
+                except queue.Empty:
+                    break
+                if q is decoded and item is not None and \
+                        not isinstance(item, _Failure):
+                    item.cancel()
+                elif q is ready and isinstance(item, PackedTensor):
+                    self._free.put(item)
+
+    def stats(self):
+        """ Items, busy seconds, items per busy second and seconds blocked
+        by the next stage of every stage, the queue depths and the overall
+        images per second """
+        elapsed = self._elapsed
+        if self._started is not None:
+            elapsed += time.perf_counter() - self._started
+        result = {}
+        for stage, stats in self._stats.items():
+            with stats.lock:
+                result[stage] = {
+                    'items': stats.items,
+                    'busy': stats.busy,
+                    'items_per_second': stats.items / stats.busy
+                    if stats.busy else 0.0,
+                    'blocked': stats.blocked}
+        result['queue_depths'] = [q.qsize() for q in self._queues]
+        result['free_buffers'] = self._free.qsize()
+        result['images_per_second'] = \
+            self._stats['pack'].items / elapsed if elapsed else 0.0
+        return result
+
+    def freebuffer(self):
+        for tensor in self._tensors:
+            tensor.freebuffer()
+        self._tensors = []
@@ -0,0 +1,212 @@
+#   Copyright (c) 2018, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import numpy as np
+from .darius_lib import C_MAX_INPUT_WIDTH, C_NUM_OF_ROWS, C_NUM_OF_COLS
+from .darius_lib import IP_CMD_LENGTH
+
+__author__ = ""
+__copyright__ = "Copyright 2018, Xilinx"
+__email__ = "pynq_support@xilinx.com"
+
+# FCLK0 of the Convolution overlay and the 64 bit AXI_HP_0 port
+DEFAULT_CLOCK_MHZ = 142.857
+DEFAULT_BYTES_PER_CYCLE = 8
+# The accumulation loopback has 10 cycle delay, so a pass over an OFM plane
+# smaller than that stalls until the partial sums come back
+ACCUM_LOOPBACK_DELAY = 10
+
+
+class LatencyModel(object):
+    """ Analytic cycle, DMA and latency model of the CNNDataflow IP
+
+    Every (OFM slice, IFM slice, kernel position) triple is one pass of the
+    C_NUM_OF_ROWS x C_NUM_OF_COLS PE array over the OFM plane, taking one
+    cycle per output pixel but at least the accumulation loopback delay.
+    The estimate is
+
+        hw_cycles = max(compute_scale * compute_cycles
+                        + pass_overhead * passes
+                        + pool_scale * pool_cycles + cmd_overhead,
+                        dma_bytes / bytes_per_cycle)
+
+    The defaults are nominal; calibrate() fits compute_scale,
+    pass_overhead, pool_scale and cmd_overhead to measured cycle counts """
+
+    def __init__(self, clock_mhz=DEFAULT_CLOCK_MHZ,
+                 bytes_per_cycle=DEFAULT_BYTES_PER_CYCLE,
+                 loopback_delay=ACCUM_LOOPBACK_DELAY, compute_scale=1.0,
+                 pass_overhead=0.0, pool_scale=1.0, cmd_overhead=0.0,
+                 host_overhead_us=0.0):
+        self.clock_mhz = clock_mhz
+        self.bytes_per_cycle = bytes_per_cycle
+        self.loopback_delay = loopback_delay
+        self.compute_scale = compute_scale
+        self.pass_overhead = pass_overhead
+        self.pool_scale = pool_scale
+        self.cmd_overhead = cmd_overhead
+        self.host_overhead_us = host_overhead_us
+
+    def sweep(self, ifm_height, ifm_width, ifm_depth, kernel_height,
+              kernel_width, pad, stride, channels, pool_kernel_height=0,
+              pool_kernel_width=0, pool_stride=0):
+        """ Estimate many layer geometries at once
+
+        The arguments are those of Darius and broadcast against each other,
+        e.g. a grid from np.meshgrid. Returns a dict of arrays with
+        hw_cycles, compute_cycles, dma_bytes, dma_cycles, latency_us,
+        efficiency and slice_utilization """
+        (ifm_height, ifm_width, ifm_depth, kernel_height, kernel_width, pad,
+         stride, channels, pool_kernel_height, pool_kernel_width,
+         pool_stride) = np.broadcast_arrays(
+            *[np.asarray(arg, dtype=np.int64) for arg in (
+                ifm_height, ifm_width, ifm_depth, kernel_height,
+                kernel_width, pad, stride, channels, pool_kernel_height,
+                pool_kernel_width, pool_stride)])
+
+        # Same derivation and maxpool gating as Darius.derive_attributes
+        ofm_height = np.ceil((ifm_height + 2 * pad - kernel_height) /
+                             stride + 1).astype(np.int64)
+        ofm_width = np.ceil((ifm_width + 2 * pad - kernel_width) /
+                            stride + 1).astype(np.int64)
+        ifm_slices = -(-ifm_depth // C_NUM_OF_ROWS)
+        ofm_slices = -(-channels // C_NUM_OF_COLS)
+        divisor = np.where(pool_stride == 0, 1, pool_stride)
+        pool_height = np.ceil((ofm_height - pool_kernel_height) / divisor + 1)
+        pool_width = np.ceil((ofm_width - pool_kernel_width) / divisor + 1)
+        pooled = (pool_stride != 0) & (pool_height > 5) & (pool_width > 5) & \
+                 (pool_width * pool_kernel_width < 1 << 9) & \
+                 (pool_width < 1 << 8)
+        pool_height = np.where(pooled, pool_height, 0).astype(np.int64)
+        pool_width = np.where(pooled, pool_width, 0).astype(np.int64)
+
+        result = self._estimate(ifm_height, ifm_width, ifm_slices,
+                                kernel_height, kernel_width, ofm_height,
+                                ofm_width, ofm_slices, pooled,
+                                np.where(pooled, pool_kernel_height, 0),
+                                pool_height, pool_width)
+        macs = ofm_height * ofm_width * channels * kernel_height * \
+            kernel_width * ifm_depth
+        result['efficiency'] = 100.0 * macs / \
+            (C_NUM_OF_ROWS * C_NUM_OF_COLS) / result['hw_cycles']
+        result['slice_utilization'] = (ifm_depth * channels) / \
+            (ifm_slices * C_NUM_OF_ROWS * ofm_slices * C_NUM_OF_COLS)
+        return result
+
+    def estimate(self, layer):
+        """ Estimate one Darius layer; returns a dict of scalars """
+        result = self.sweep(layer.ifm_height, layer.ifm_width,
+                            layer.ifm_depth, layer.kernel_height,
+                            layer.kernel_width, layer.pad, layer.stride,
+                            layer.channels, layer.pool_kernel_height,
+                            layer.pool_kernel_width, layer.pool_stride)
+        return {key: value.item() for key, value in result.items()}
+
+    def command_cycles(self, cmd):
+        """ hw_cycles of a command parsed by parse_IP_cmd; usable as the
+        cycle_model of VirtualCNNDataflow """
+        pooled = cmd['pool_stride'] != 0
+        result = self._estimate(*[np.asarray(value) for value in (
+            cmd['ifm_height'], cmd['ifm_width'], cmd['ifm_slices'],
+            cmd['kernel_height'], cmd['kernel_width'], cmd['ofm_height'],
+            cmd['ofm_width'], cmd['ofm_slices'], pooled,
+            cmd['pool_kernel_height'], cmd['pool_output_height'],
+            cmd['pool_output_width'])])
+        return int(result['hw_cycles'])
+
+    __call__ = command_cycles
+
+    def _features(self, ifm_height, ifm_width, ifm_slices, kernel_height,
+                  kernel_width, ofm_height, ofm_width, ofm_slices, pooled,
+                  pool_kernel_height, pool_height, pool_width):
+        passes = ofm_slices * ifm_slices * kernel_height * kernel_width
+        compute_cycles = passes * np.maximum(ofm_height * ofm_width,
+                                             self.loopback_delay)
+        # The maxpool drains one line buffer of pool_kernel_height OFM rows
+        # per OFM slice after the last pass
+        pool_cycles = np.where(pooled, ofm_slices * pool_kernel_height *
+                               ofm_width, 0)
+        return compute_cycles, passes, pool_cycles
+
+    def _estimate(self, ifm_height, ifm_width, ifm_slices, kernel_height,
+                  kernel_width, ofm_height, ofm_width, ofm_slices, pooled,
+                  pool_kernel_height, pool_height, pool_width):
+        compute_cycles, passes, pool_cycles = self._features(
+            ifm_height, ifm_width, ifm_slices, kernel_height, kernel_width,
+            ofm_height, ofm_width, ofm_slices, pooled, pool_kernel_height,
+            pool_height, pool_width)
+
+        word = C_MAX_INPUT_WIDTH // 8
+        out_height = np.where(pooled, pool_height, ofm_height)
+        out_width = np.where(pooled, pool_width, ofm_width)
+        # The line buffer holds one IFM slice plane, so the IFM is streamed
+        # once per OFM slice
+        ifm_bytes = ofm_slices * ifm_slices * C_NUM_OF_ROWS * \
+            ifm_height * ifm_width * word
+        weights_bytes = passes * C_NUM_OF_ROWS * C_NUM_OF_COLS * word
+        ofm_bytes = ofm_slices * C_NUM_OF_COLS * out_height * out_width * word
+        dma_bytes = ifm_bytes + weights_bytes + ofm_bytes + IP_CMD_LENGTH
+        dma_cycles = dma_bytes / self.bytes_per_cycle
+
+        busy_cycles = self.compute_scale * compute_cycles + \
+            self.pass_overhead * passes + \
+            self.pool_scale * pool_cycles + self.cmd_overhead
+        hw_cycles = np.ceil(np.maximum(busy_cycles, dma_cycles))
+        return {'hw_cycles': hw_cycles.astype(np.int64),
+                'compute_cycles': compute_cycles,
+                'dma_bytes': dma_bytes,
+                'dma_cycles': dma_cycles,
+                'latency_us': hw_cycles / self.clock_mhz +
+                self.host_overhead_us}
+
+    def calibrate(self, layers, hw_cycles):
+        """ Least squares fit of compute_scale, pass_overhead, pool_scale and
+        cmd_overhead to the cycle counts measured for a list of Darius
+        layers; the DMA bound is not fitted, so use compute bound layers.
+        Returns the relative error of the fitted model per layer """
+        features = []
+        for layer in layers:
+            pooled = layer.pool_stride != 0
+            compute_cycles, passes, pool_cycles = self._features(
+                layer.ifm_height, layer.ifm_width, layer.ifm_slices,
+                layer.kernel_height, layer.kernel_width, layer.ofm_height,
+                layer.ofm_width, layer.ofm_slices, pooled,
+                layer.pool_kernel_height, layer.pool_output_height,
+                layer.pool_output_width)
+            features.append([compute_cycles, passes, pool_cycles, 1])
+        features = np.asarray(features, dtype=np.float64)
+        measured = np.asarray(hw_cycles, dtype=np.float64)
+        coefficients = np.linalg.lstsq(features, measured, rcond=None)[0]
+        (self.compute_scale, self.pass_overhead, self.pool_scale,
+         self.cmd_overhead) = np.maximum(coefficients, 0).tolist()
+
+        predicted = np.array([self.estimate(layer)['hw_cycles']
+                              for layer in layers], dtype=np.float64)
+        return (predicted - measured) / measured
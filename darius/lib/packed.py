@@ -0,0 +1,172 @@
+#   Copyright (c) 2018, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import numpy as np
+from .darius_lib import C_NUM_OF_ROWS, _hw_view, _lane_ranges, pack_slices
+from .reference import maxpool_hwc
+from .trace import traced
+
+__author__ = ""
+__copyright__ = "Copyright 2018, Xilinx"
+__email__ = "pynq_support@xilinx.com"
+
+
+class PackedTensor(object):
+    """ A (channels, height, width) volume kept in physical memory in the
+    slice interleaved layout the CNNDataflow IP reads IFMs and writes OFMs
+    in, (slices, height, width, C_NUM_OF_ROWS)
+
+    The OFM of a layer is an IFM for the next layer as it is, so a tensor
+    is passed on without touching the host copy; as_ifm() only converts
+    when the next layer really expects a different format. The lanes past
+    channels in the last slice are kept at zero or multiplied with zero
+    weights """
+
+    def __init__(self, buffer, channels, height, width):
+        self.buffer = buffer
+        self.channels = channels
+        self.height = height
+        self.width = width
+
+    @classmethod
+    def allocate(cls, pool, channels, height, width):
+        """ Tensor on a buffer taken from a BufferPool """
+        slices = -(-channels // C_NUM_OF_ROWS)
+        buffer = pool.allocate(slices * height * width * C_NUM_OF_ROWS,
+                               np.int16)
+        return cls(buffer, channels, height, width)
+
+    @classmethod
+    def ifm(cls, layer, buffer):
+        """ Tensor of the IFM of a Darius layer in buffer """
+        return cls(buffer, layer.ifm_depth, layer.ifm_height, layer.ifm_width)
+
+    @classmethod
+    def ofm(cls, layer, buffer):
+        """ Tensor of the OFM of a Darius layer in buffer """
+        return cls(buffer, *layer.ofm_shape())
+
+    @property
+    def slices(self):
+        return -(-self.channels // C_NUM_OF_ROWS)
+
+    @property
+    def shape(self):
+        return (self.channels, self.height, self.width)
+
+    @property
+    def hw(self):
+        """ (slices, height, width, C_NUM_OF_ROWS) view of the buffer """
+        return _hw_view(self.buffer, (self.slices, self.height, self.width,
+                                      C_NUM_OF_ROWS))
+
+    @property
+    def physical_address(self):
+        return self.buffer.physical_address
+
+    def flush(self):
+        self.buffer.flush()
+
+    def invalidate(self):
+        self.buffer.invalidate()
+
+    def freebuffer(self):
+        self.buffer.freebuffer()
+
+    def matches(self, layer):
+        """ True when the IP can read this tensor as the IFM of layer """
+        return (self.height, self.width, self.slices) == \
+            (layer.ifm_height, layer.ifm_width, layer.ifm_slices)
+
+    @traced('pack_ifm')
+    def pack(self, array):
+        """ Pack a row-major (channels, height, width) volume into the
+        tensor """
+        src = np.asarray(array).reshape(self.shape)
+        pack_slices(src, self.hw)
+        return self
+
+    @traced('unpack')
+    def unpack(self, out=None):
+        """ Row-major (channels, height, width) copy of the tensor """
+        if out is None:
+            out = np.empty(self.shape, dtype=self.buffer.dtype)
+        elif out.shape != self.shape:
+            raise ValueError("Output buffer has shape %s, expected %s"
+                             % (out.shape, self.shape))
+        hw = self.hw
+        for first, last, lanes in _lane_ranges(self.channels, C_NUM_OF_ROWS):
+            block = out[first * C_NUM_OF_ROWS:
+                        first * C_NUM_OF_ROWS + (last - first) * lanes]
+            block = block.reshape(last - first, lanes, self.height,
+                                  self.width)
+            np.copyto(block, hw[first:last, ..., :lanes].transpose(
+                0, 3, 1, 2), casting='unsafe')
+        return out
+
+
+def as_ifm(tensor, layer, pool, maxpool=None):
+    """ Tensor holding tensor in the IFM format of layer
+
+    The tensor itself is returned when the IP can read it as it is. When
+    the layer has more slices than the tensor, the slices of the tensor
+    are copied slice to slice into a new tensor from pool and the rest
+    zero filled; maxpool=(kernel height, kernel width, stride) applies a
+    maxpool in the packed layout on the way, for an OFM written without
+    the IP maxpool. A tensor with more channels than the layer's IFM
+    depth, or any other mismatch, raises a ValueError """
+    if tensor.channels > layer.ifm_depth:
+        raise ValueError("Tensor of %d channels can not be the IFM of a "
+                         "layer of depth %d" % (tensor.channels,
+                                                layer.ifm_depth))
+    if maxpool is None and tensor.matches(layer):
+        return tensor
+    hw = tensor.hw
+    height, width = tensor.height, tensor.width
+    if maxpool is not None:
+        kernel_height, kernel_width, stride = maxpool
+        height = -(-(height - kernel_height) // stride) + 1
+        width = -(-(width - kernel_width) // stride) + 1
+    if (height, width) != (layer.ifm_height, layer.ifm_width):
+        raise ValueError("Tensor of shape %s can not be the IFM (%d, %d, %d) "
+                         "of the layer" % (tensor.shape, layer.ifm_depth,
+                                           layer.ifm_height,
+                                           layer.ifm_width))
+    converted = PackedTensor.allocate(pool, layer.ifm_depth, height, width)
+    dst = converted.hw
+    for i in range(tensor.slices):
+        if maxpool is not None:
+            dst[i] = maxpool_hwc(hw[i], kernel_height, kernel_width, stride,
+                                 height, width)
+        else:
+            dst[i] = hw[i]
+    if converted.slices > tensor.slices:
+        dst[tensor.slices:] = 0
+    return converted
@@ -0,0 +1,104 @@
+#   Copyright (c) 2018, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+from .darius_lib import IP_start, IP_wait
+
+__author__ = ""
+__copyright__ = "Copyright 2018, Xilinx"
+__email__ = "pynq_support@xilinx.com"
+
+
+class Program(object):
+    """ A stack of Darius layers run with a single start of the CNNDataflow
+    IP from one contiguous command buffer
+
+    Layers added with chain=True read their IFM from the OFM buffer of the
+    previous layer, which the IP already writes in the IFM layout """
+
+    def __init__(self, layers=()):
+        self.layers = []
+        for layer in layers:
+            self.add(layer)
+
+    def add(self, layer, chain=True):
+        """ Append a layer, feeding it the OFM of the previous layer """
+        if chain and self.layers:
+            prev = self.layers[-1]
+            if prev.pool_stride != 0:
+                height = prev.pool_output_height
+                width = prev.pool_output_width
+            else:
+                height, width = prev.ofm_height, prev.ofm_width
+            if (layer.ifm_depth, layer.ifm_height, layer.ifm_width) != \
+                    (prev.channels, height, width):
+                raise ValueError(
+                    "Layer %d IFM (%d, %d, %d) does not match the OFM of "
+                    "layer %d (%d, %d, %d)"
+                    % (len(self.layers), layer.ifm_depth, layer.ifm_height,
+                       layer.ifm_width, len(self.layers) - 1, prev.channels,
+                       height, width))
+            layer.ifm_baseaddr = prev.ofm_baseaddr
+        self.layers.append(layer)
+        return layer
+
+    @property
+    def num_commands(self):
+        return len(self.layers)
+
+    def IP_cmd(self):
+        """ Concatenated commands of all layers, or False if any layer is
+        not supported by the CNNDataflow IP """
+        cmds = []
+        for i, layer in enumerate(self.layers):
+            cmd = layer.IP_cmd()
+            if cmd is False:
+                print("ERROR: LAYER %d OF THE PROGRAM IS NOT SUPPORTED" % i)
+                return False
+            cmds.append(cmd)
+        return b''.join(cmds)
+
+    def load(self, cmd_mem, offset=0):
+        """ Write the commands through an MMIO of the command buffer """
+        cmds = self.IP_cmd()
+        if cmds is False:
+            return False
+        cmd_mem.write(offset, cmds)
+        return cmds
+
+    def start(self, cnn, cmd_baseaddr):
+        """ Start the IP on the loaded commands """
+        return IP_start(cnn, cmd_baseaddr, self.num_commands)
+
+    def run(self, cnn, cmd_mem, cmd_baseaddr):
+        """ Load the commands, run the whole stack and return the cycle
+        count; returns False if the program could not be started """
+        if self.load(cmd_mem) is False or not self.start(cnn, cmd_baseaddr):
+            return False
+        return IP_wait(cnn)
@@ -0,0 +1,157 @@
+#   Copyright (c) 2018, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+from math import floor, log2
+import numpy as np
+from .darius_lib import C_MAX_INPUT_WIDTH, C_NUM_OF_ROWS, C_NUM_OF_COLS
+from .darius_lib import _hw_view, pack_slices, pack_weights
+from .reference import conv2d_hwc
+from .trace import traced
+
+__author__ = ""
+__copyright__ = "Copyright 2018, Xilinx"
+__email__ = "pynq_support@xilinx.com"
+
+# Elements of float data quantized at a time by the packers
+QUANT_CHUNK_SIZE = 1 << 16
+QUANT_MAX = (1 << (C_MAX_INPUT_WIDTH - 1)) - 1
+QUANT_MIN = -(1 << (C_MAX_INPUT_WIDTH - 1))
+
+
+def frac_bits(values, percentile=100.0, width=C_MAX_INPUT_WIDTH):
+    """ Largest number of fractional bits with which the given percentile
+    of abs(values) fits a signed fixed-point number of width bits """
+    values = np.abs(np.asarray(values, dtype=np.float32)).ravel()
+    if percentile >= 100.0:
+        peak = float(values.max()) if values.size else 0.0
+    else:
+        peak = float(np.percentile(values, percentile))
+    if peak == 0.0:
+        return width - 1
+    return floor(log2(((1 << (width - 1)) - 1) / peak))
+
+
+def quantize_array(values, bits, out=None):
+    """ Round values * 2**bits to the nearest integer and saturate it to
+    C_MAX_INPUT_WIDTH bits; the result has the dtype of out or float32 """
+    values = np.asarray(values)
+    if out is None:
+        out = np.empty(values.shape, dtype=np.float32)
+    np.multiply(values, np.float32(2.0 ** bits), out=out, casting='unsafe')
+    np.rint(out, out=out)
+    np.clip(out, QUANT_MIN, QUANT_MAX, out=out)
+    return out
+
+
+@traced('pack_ifm')
+def quantize_and_pack_ifm(layer, ifm_sw, ifm, bits, chunk=QUANT_CHUNK_SIZE):
+    """ Quantize a row-major float IFM volume with bits fractional bits
+    straight into the packed IFM layout of layer in physical memory with
+    ifm pointer, a few slices at a time so only chunk floats are kept """
+    plane = layer.ifm_height * layer.ifm_width
+    src = np.asarray(ifm_sw).reshape(-1)[:layer.ifm_depth * plane]
+    src = src.reshape(layer.ifm_depth, plane)
+    dst = _hw_view(ifm, (layer.ifm_slices, plane, C_NUM_OF_ROWS))
+    step = max(chunk // (plane * C_NUM_OF_ROWS), 1)
+    scratch = np.empty((step * C_NUM_OF_ROWS, plane), dtype=np.float32)
+    for first in range(0, layer.ifm_slices, step):
+        last = min(first + step, layer.ifm_slices)
+        block = src[first * C_NUM_OF_ROWS:last * C_NUM_OF_ROWS]
+        pack_slices(quantize_array(block, bits, scratch[:len(block)]),
+                    dst[first:last])
+
+
+@traced('pack_weights')
+def quantize_and_pack_weights(layer, weights_sw, weights, bits,
+                              chunk=QUANT_CHUNK_SIZE):
+    """ Quantize row-major float weights with bits fractional bits straight
+    into the packed weights layout of layer in physical memory with weights
+    pointer, a few output channel slices at a time """
+    kernel_size = layer.kernel_height * layer.kernel_width
+    src = np.asarray(weights_sw).reshape(-1)[:layer.channels *
+                                             layer.weight_offset]
+    src = src.reshape(layer.channels, layer.ifm_depth, kernel_size)
+    dst = _hw_view(weights, (layer.ofm_slices, layer.ifm_slices, kernel_size,
+                             C_NUM_OF_ROWS, C_NUM_OF_COLS))
+    step = max(chunk // (layer.weight_offset * C_NUM_OF_COLS), 1)
+    scratch = np.empty((step * C_NUM_OF_COLS, layer.ifm_depth, kernel_size),
+                       dtype=np.float32)
+    for first in range(0, layer.ofm_slices, step):
+        last = min(first + step, layer.ofm_slices)
+        block = src[first * C_NUM_OF_COLS:last * C_NUM_OF_COLS]
+        pack_weights(quantize_array(block, bits, scratch[:len(block)]),
+                     dst[first:last])
+
+
+def dequantize_ofm(layer, ofm, bits, out=None):
+    """ Unpack the OFM of layer to a row-major float32 volume, scaling the
+    fixed-point values with bits fractional bits back to real values """
+    if out is None:
+        out = np.empty(layer.ofm_shape(), dtype=np.float32)
+    return layer.unpack_ofm(ofm, out=out, shift=bits)
+
+
+def calibrate(layer, ifm_samples, weights_sw, percentile=100.0):
+    """ Pick the fixed-point formats of a layer from float sample IFMs and
+    its float weights
+
+    Returns a dict with the fractional bits of the IFM, the weights and the
+    OFM. The IFM and weights formats are chosen to fit their own ranges;
+    since the IP writes out the low C_MAX_INPUT_WIDTH bits of the
+    accumulators, bits are then taken from the larger of the two until the
+    quantized outputs of the samples fit as well """
+    samples = np.asarray(ifm_samples, dtype=np.float32).reshape(
+        -1, layer.ifm_depth, layer.ifm_height, layer.ifm_width)
+    weights_sw = np.asarray(weights_sw, dtype=np.float32).reshape(
+        layer.channels, layer.ifm_depth, layer.kernel_height,
+        layer.kernel_width)
+    ifm_bits = frac_bits(samples, percentile)
+    weights_bits = frac_bits(weights_sw, 100.0)
+
+    ifm_hwc = samples.transpose(0, 2, 3, 1)
+    weights_hwio = weights_sw.transpose(2, 3, 1, 0)
+    while True:
+        weights_q = quantize_array(weights_hwio, weights_bits)
+        peak = 0
+        for sample in quantize_array(ifm_hwc, ifm_bits):
+            ofm = conv2d_hwc(sample, weights_q, layer.stride, layer.pad,
+                             layer.ofm_height, layer.ofm_width)
+            peak = max(peak, int(np.abs(ofm).max()))
+        if peak <= QUANT_MAX:
+            break
+        excess = max(int(np.ceil(log2(peak / QUANT_MAX))), 1)
+        for _ in range(excess):
+            if ifm_bits >= weights_bits:
+                ifm_bits -= 1
+            else:
+                weights_bits -= 1
+    return {'ifm_frac_bits': ifm_bits,
+            'weights_frac_bits': weights_bits,
+            'ofm_frac_bits': ifm_bits + weights_bits}
@@ -0,0 +1,164 @@
+#   Copyright (c) 2018, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import numpy as np
+from .darius_lib import C_MAX_INPUT_WIDTH, C_NUM_OF_ROWS, C_NUM_OF_COLS
+from .darius_lib import parse_IP_cmd, _hw_view
+
+__author__ = ""
+__copyright__ = "Copyright 2018, Xilinx"
+__email__ = "pynq_support@xilinx.com"
+
+# Width of the CNNDataflow IP accumulators. The partial sums wrap at this
+# width and the OFM keeps the low C_MAX_INPUT_WIDTH bits of the result
+C_ACCUM_WIDTH = 32
+
+
+def _wrap(values, width):
+    """ Two's complement wrap of an int64 array to the given bit width """
+    if width >= 64:
+        return values
+    half = 1 << (width - 1)
+    return ((values + half) & ((1 << width) - 1)) - half
+
+
+def _windows(volume, kernel_height, kernel_width, stride, rows, cols):
+    """ Read-only (rows, cols, kernel_height, kernel_width, depth) view of
+    the windows of an (height, width, depth) volume, which has to hold
+    all of them """
+    row_stride, col_stride, depth_stride = volume.strides
+    return np.lib.stride_tricks.as_strided(
+        volume, shape=(rows, cols, kernel_height, kernel_width,
+                       volume.shape[2]),
+        strides=(row_stride * stride, col_stride * stride, row_stride,
+                 col_stride, depth_stride), writeable=False)
+
+
+def conv2d_hwc(ifm, weights, stride, pad, ofm_height, ofm_width):
+    """ Exact integer convolution of an (height, width, depth) IFM with
+    (kernel_height, kernel_width, depth, channels) weights
+
+    The products are summed in float64 through BLAS, which is exact for
+    16-bit operands and up to 2^22 terms, and returned as int64 """
+    height, width, depth = ifm.shape
+    kernel_height, kernel_width = weights.shape[:2]
+    padded_height = max(height + 2 * pad,
+                        (ofm_height - 1) * stride + kernel_height)
+    padded_width = max(width + 2 * pad,
+                       (ofm_width - 1) * stride + kernel_width)
+    padded = np.zeros((padded_height, padded_width, depth), dtype=np.float64)
+    padded[pad:pad + height, pad:pad + width] = ifm
+
+    # The windows are (kh, kw, depth) like the weights
+    columns = _windows(padded, kernel_height, kernel_width, stride,
+                       ofm_height, ofm_width).reshape(
+                           ofm_height * ofm_width, -1)
+    ofm = columns @ weights.reshape(-1, weights.shape[-1]).astype(np.float64)
+    return ofm.reshape(ofm_height, ofm_width, -1).astype(np.int64)
+
+
+def maxpool_hwc(ofm, kernel_height, kernel_width, stride, pool_height,
+                pool_width):
+    """ Maxpool of an (height, width, channels) volume; windows running past
+    the bottom/right edge only cover the valid part of the volume """
+    height, width, channels = ofm.shape
+    padded_height = max(height, (pool_height - 1) * stride + kernel_height)
+    padded_width = max(width, (pool_width - 1) * stride + kernel_width)
+    if (padded_height, padded_width) != (height, width):
+        lowest = np.iinfo(ofm.dtype).min if \
+            np.issubdtype(ofm.dtype, np.integer) else -np.inf
+        padded = np.full((padded_height, padded_width, channels), lowest,
+                         dtype=ofm.dtype)
+        padded[:height, :width] = ofm
+        ofm = padded
+    return _windows(ofm, kernel_height, kernel_width, stride, pool_height,
+                    pool_width).max(axis=(2, 3))
+
+
+def unpack_ifm_hwc(cmd, ifm):
+    """ (height, width, depth) view of the packed IFM of a parsed command """
+    height, width = cmd['ifm_height'], cmd['ifm_width']
+    packed = _hw_view(ifm, (cmd['ifm_slices'], height, width, C_NUM_OF_ROWS))
+    return packed.transpose(1, 2, 0, 3).reshape(height, width, -1)
+
+
+def unpack_weights_hwio(cmd, weights):
+    """ (kernel_height, kernel_width, depth, channels) view of the packed
+    weights of a parsed command """
+    kernel_height, kernel_width = cmd['kernel_height'], cmd['kernel_width']
+    packed = _hw_view(weights, (cmd['ofm_slices'], cmd['ifm_slices'],
+                                kernel_height, kernel_width,
+                                C_NUM_OF_ROWS, C_NUM_OF_COLS))
+    return packed.transpose(2, 3, 1, 4, 0, 5).reshape(
+        kernel_height, kernel_width, cmd['ifm_slices'] * C_NUM_OF_ROWS, -1)
+
+
+def run_IP_cmd(cmd, ifm, weights, ofm=None, accum_width=C_ACCUM_WIDTH):
+    """ Software model of one CNNDataflow IP command
+
+    Takes the bytes built by Darius.IP_cmd() and the packed IFM and weights
+    buffers (starting at the command's base addresses) and writes the packed
+    OFM the IP would produce: 16-bit products summed in accum_width-bit
+    wrapping accumulators, the low C_MAX_INPUT_WIDTH bits written out and
+    the maxpool applied to them when the command enables it """
+    if isinstance(cmd, dict):
+        fields = cmd
+    else:
+        fields = parse_IP_cmd(cmd)
+    ofm_height, ofm_width = fields['ofm_height'], fields['ofm_width']
+    ofm_slices = fields['ofm_slices']
+
+    if fields['pool_stride'] != 0:
+        out_height = fields['pool_output_height']
+        out_width = fields['pool_output_width']
+    else:
+        out_height, out_width = ofm_height, ofm_width
+    if fields['ofm_packet_length'] != out_height * out_width * ofm_slices:
+        raise ValueError("CNNDataflow IP command OFM packet length does not "
+                         "match its dimensions")
+    if ofm is None:
+        ofm = np.zeros(fields['ofm_packet_length'] * C_NUM_OF_COLS,
+                       dtype='int%d' % C_MAX_INPUT_WIDTH)
+
+    acc = conv2d_hwc(unpack_ifm_hwc(fields, ifm),
+                     unpack_weights_hwio(fields, weights),
+                     fields['stride'], fields['pad'], ofm_height, ofm_width)
+    result = _wrap(_wrap(acc, accum_width), C_MAX_INPUT_WIDTH)
+    result = result.astype('int%d' % C_MAX_INPUT_WIDTH)
+    if fields['pool_stride'] != 0:
+        result = maxpool_hwc(result, fields['pool_kernel_height'],
+                             fields['pool_kernel_width'],
+                             fields['pool_stride'], out_height, out_width)
+
+    dst = _hw_view(ofm, (ofm_slices, out_height, out_width, C_NUM_OF_COLS))
+    np.copyto(dst, result.reshape(out_height, out_width, ofm_slices,
+                                  C_NUM_OF_COLS).transpose(2, 0, 1, 3),
+              casting='unsafe')
+    return ofm
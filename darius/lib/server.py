@@ -0,0 +1,472 @@
+#   Copyright (c) 2018, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+""" Local inference server with dynamic batching
+
+    python -m darius.lib.server serve --model model.npz --port 8080
+    python -m darius.lib.server load --url http://127.0.0.1:8080
+
+A model is an .npz written by save_model: the Darius arguments of every
+layer and its row-major weights. POST /infer takes the raw int16 bytes of
+one row-major IFM volume and returns the raw int16 bytes of the OFM of the
+last layer, with its shape in the X-Shape header; GET /stats returns the
+batcher statistics as JSON. Concurrent requests are run as one batch of
+up to --max-batch images, waiting at most --max-delay seconds for a batch
+to fill """
+
+import argparse
+import collections
+import copy
+import json
+import queue
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.request import Request, urlopen
+import numpy as np
+from .darius_lib import Darius, C_MAX_INPUT_WIDTH
+from .darius_lib import IP_start, IP_wait
+from .batch import BatchedLayer
+from .buffer_pool import BufferPool
+from .compiler import DARIUS_ARGS
+from .hybrid import cpu_conv
+from .program import Program
+
+__author__ = ""
+__copyright__ = "Copyright 2018, Xilinx"
+__email__ = "pynq_support@xilinx.com"
+
+DEFAULT_MAX_BATCH = 8
+DEFAULT_MAX_DELAY = 0.005
+# Latencies kept for the percentiles
+LATENCY_WINDOW = 4096
+
+
+def save_model(path, layers, weights):
+    """ Write the Darius arguments and row-major weights of a stack of
+    layers to an .npz model """
+    configs = [{arg: getattr(layer, arg) for arg in DARIUS_ARGS}
+               for layer in layers]
+    arrays = {'weights_%d' % i: np.asarray(layer_weights)
+              for i, layer_weights in enumerate(weights)}
+    np.savez(path, configs=json.dumps(configs), **arrays)
+
+
+def load_model(path):
+    """ (layers, weights) of an .npz model """
+    with np.load(path) as model:
+        configs = json.loads(str(model['configs']))
+        weights = [model['weights_%d' % i] for i in range(len(configs))]
+    layers = [Darius(*[config[arg] for arg in DARIUS_ARGS], 0, 0, 0,
+                     verbose=False)
+              for config in configs]
+    return layers, weights
+
+
+def check_model(layers, weights):
+    """ Raise a ValueError unless every layer has weights and reads the OFM
+    of the previous layer """
+    if len(weights) != len(layers):
+        raise ValueError("Model of %d layers has %d weights"
+                         % (len(layers), len(weights)))
+    Program([copy.copy(layer) for layer in layers])
+
+
+class SoftwareBackend(object):
+    """ Runs batches of a model with cpu_conv, for off-board serving and
+    testing """
+
+    def __init__(self, layers, weights, threads=None):
+        check_model(layers, weights)
+        self.layers = layers
+        self.weights = weights
+        self.threads = ThreadPoolExecutor(threads) if threads else None
+        self.bands = threads or 1
+
+    @property
+    def input_shape(self):
+        first = self.layers[0]
+        return (first.ifm_depth, first.ifm_height, first.ifm_width)
+
+    def run_batch(self, ifms):
+        outputs = []
+        for ifm_sw in ifms:
+            for layer, layer_weights in zip(self.layers, self.weights):
+                ifm_sw = cpu_conv(layer, ifm_sw, layer_weights, self.threads,
+                                  self.bands)
+            outputs.append(ifm_sw)
+        return np.stack(outputs)
+
+
+class AcceleratorBackend(object):
+    """ Runs batches of a model on the CNNDataflow IP with one start
+
+    The weights of every layer are packed once and stay resident. A batch
+    of N images runs as one program of N commands per layer, each layer
+    reading the batch OFM of the previous one from the other of two ping
+    pong buffers; the commands are built once per batch size """
+
+    def __init__(self, cnn, layers, weights, pool=None,
+                 max_batch=DEFAULT_MAX_BATCH):
+        check_model(layers, weights)
+        self.cnn = cnn
+        self.pool = pool if pool is not None else BufferPool()
+        self.max_batch = max_batch
+        self.layers = []
+        self._weights = []
+        for layer, layer_weights in zip(layers, weights):
+            packed = self.pool.allocate(
+                layer.weight_depth_offset * layer.ofm_slices, np.int16)
+            layer.reshape_and_copy_weights(layer_weights, packed)
+            packed.flush()
+            layer = copy.copy(layer)
+            layer.weights_baseaddr = packed.physical_address
+            layer.verbose = False
+            self.layers.append(layer)
+            self._weights.append(packed)
+        size = max_batch * max(
+            max(BatchedLayer(layer, 1).ifm_length,
+                BatchedLayer(layer, 1).ofm_length) for layer in self.layers)
+        self._pingpong = [self.pool.allocate(size, np.int16)
+                          for _ in range(2)]
+        self._programs = {}
+
+    @property
+    def input_shape(self):
+        first = self.layers[0]
+        return (first.ifm_depth, first.ifm_height, first.ifm_width)
+
+    def _program(self, batch):
+        """ (batched layers, command buffer) of a batch size """
+        cached = self._programs.get(batch)
+        if cached is None:
+            program = Program()
+            batched = []
+            for i, layer in enumerate(self.layers):
+                hw_layer = copy.copy(layer)
+                hw_layer.ifm_baseaddr = self._pingpong[i % 2].physical_address
+                hw_layer.ofm_baseaddr = \
+                    self._pingpong[(i + 1) % 2].physical_address
+                batched.append(BatchedLayer(hw_layer, batch))
+                for image in batched[-1].program().layers:
+                    program.add(image, chain=False)
+            cmds = program.IP_cmd()
+            if cmds is False:
+                raise ValueError("Model is not supported by the CNNDataflow "
+                                 "IP")
+            cmd = self.pool.allocate(len(cmds), np.uint8)
+            cmd[:] = np.frombuffer(cmds, np.uint8)
+            cmd.flush()
+            cached = (batched, cmd, program.num_commands)
+            self._programs[batch] = cached
+        return cached
+
+    def run_batch(self, ifms):
+        if len(ifms) > self.max_batch:
+            raise ValueError("Batch of %d exceeds max_batch %d"
+                             % (len(ifms), self.max_batch))
+        batched, cmd, num_commands = self._program(len(ifms))
+        src = self._pingpong[0]
+        batched[0].reshape_and_copy_ifm(ifms, src)
+        src.flush()
+        if not IP_start(self.cnn, cmd.physical_address, num_commands):
+            raise RuntimeError("CNNDataflow IP busy")
+        IP_wait(self.cnn)
+        dst = self._pingpong[len(batched) % 2]
+        dst.invalidate()
+        return batched[-1].unpack_ofm(dst)
+
+    def freebuffer(self):
+        for buf in self._weights + self._pingpong:
+            buf.freebuffer()
+        for _, cmd, _ in self._programs.values():
+            cmd.freebuffer()
+        self._programs = {}
+
+
+class InvalidRequest(ValueError):
+    """ A request that does not hold an IFM volume of the model """
+
+
+class DynamicBatcher(object):
+    """ Collects concurrent requests into batches for a backend
+
+    A batch is run as soon as it holds max_batch requests or max_delay
+    seconds after its first request arrived. Keeps the queue depth, a
+    histogram of the batch sizes and a window of request latencies """
+
+    def __init__(self, backend, max_batch=DEFAULT_MAX_BATCH,
+                 max_delay=DEFAULT_MAX_DELAY):
+        self.backend = backend
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.batch_sizes = collections.Counter()
+        self.completed = 0
+        self._latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self._lock = threading.Lock()
+        self._requests = queue.Queue()
+        self._started = time.perf_counter()
+        self._worker = threading.Thread(target=self._loop, daemon=True)
+        self._worker.start()
+
+    def submit(self, ifm_sw):
+        """ Queue one row-major IFM volume; returns a Future of the OFM, which
+        fails with InvalidRequest right away when the volume does not have
+        the size of the model input """
+        future = Future()
+        ifm_sw = np.asarray(ifm_sw)
+        shape = self.backend.input_shape
+        if ifm_sw.size != int(np.prod(shape)):
+            future.set_exception(InvalidRequest(
+                "IFM of %d elements does not match the model input %s"
+                % (ifm_sw.size, shape)))
+            return future
+        self._requests.put((ifm_sw.reshape(shape), future,
+                            time.perf_counter()))
+        return future
+
+    @property
+    def queue_depth(self):
+        return self._requests.qsize()
+
+    def _collect(self):
+        request = self._requests.get()
+        if request is None:
+            return None
+        batch = [request]
+        deadline = request[2] + self.max_delay
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            try:
+                request = self._requests.get(timeout=max(timeout, 0)) \
+                    if timeout > 0 else self._requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                self._requests.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            try:
+                ifms = np.stack([ifm_sw for ifm_sw, _, _ in batch])
+                outputs = self.backend.run_batch(ifms)
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            done = time.perf_counter()
+            with self._lock:
+                self.batch_sizes[len(batch)] += 1
+                self.completed += len(batch)
+                self._latencies.extend(done - arrived
+                                       for _, _, arrived in batch)
+            for output, (_, future, _) in zip(outputs, batch):
+                future.set_result(output)
+
+    def stats(self):
+        """ Queue depth, completed requests and requests per second, the
+        batch size histogram and the p50/p90/p99 latency in seconds """
+        with self._lock:
+            latencies = np.array(self._latencies)
+            histogram = dict(sorted(self.batch_sizes.items()))
+            completed = self.completed
+        elapsed = time.perf_counter() - self._started
+        stats = {'queue_depth': self.queue_depth,
+                 'completed': completed,
+                 'requests_per_second': completed / elapsed,
+                 'batch_sizes': histogram}
+        if latencies.size:
+            p50, p90, p99 = np.percentile(latencies, (50, 90, 99))
+            stats.update(latency_p50=float(p50), latency_p90=float(p90),
+                         latency_p99=float(p99))
+        return stats
+
+    def shutdown(self):
+        self._requests.put(None)
+        self._worker.join()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def _reply(self, body, content_type, headers=()):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            self.send_error(404)
+            return
+        stats = self.server.batcher.stats()
+        stats['batch_sizes'] = {str(size): count for size, count
+                                in stats['batch_sizes'].items()}
+        self._reply(json.dumps(stats).encode(), 'application/json')
+
+    def do_POST(self):
+        if self.path != '/infer':
+            self.send_error(404)
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        word = C_MAX_INPUT_WIDTH // 8
+        if len(body) % word:
+            self.send_error(400, "Body is not a whole number of int%d "
+                            "elements" % C_MAX_INPUT_WIDTH)
+            return
+        ifm_sw = np.frombuffer(body, dtype='int%d' % C_MAX_INPUT_WIDTH)
+        try:
+            ofm = self.server.batcher.submit(ifm_sw).result()
+        except InvalidRequest as e:
+            self.send_error(400, str(e))
+            return
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+        ofm = np.ascontiguousarray(ofm, dtype='int%d' % C_MAX_INPUT_WIDTH)
+        self._reply(ofm.tobytes(), 'application/octet-stream',
+                    [('X-Shape', ','.join(str(dim) for dim in ofm.shape))])
+
+    def log_message(self, format, *args):
+        pass
+
+
+class InferenceServer(socketserver.ThreadingMixIn, HTTPServer):
+    """ HTTP front end of a DynamicBatcher on a local address """
+
+    daemon_threads = True
+    # Concurrent clients beyond the default backlog of 5 would see their
+    # connections retried after a second
+    request_queue_size = 128
+
+    def __init__(self, batcher, host='127.0.0.1', port=8080):
+        super().__init__((host, port), _Handler)
+        self.batcher = batcher
+
+
+def infer(url, ifm_sw):
+    """ Send one IFM volume to a server and return its OFM """
+    data = np.ascontiguousarray(ifm_sw, dtype='int%d' % C_MAX_INPUT_WIDTH)
+    request = Request(url.rstrip('/') + '/infer', data=data.tobytes(),
+                      headers={'Content-Type': 'application/octet-stream'})
+    with urlopen(request) as response:
+        shape = tuple(int(dim) for dim in
+                      response.headers['X-Shape'].split(','))
+        return np.frombuffer(response.read(),
+                             dtype='int%d' % C_MAX_INPUT_WIDTH).reshape(shape)
+
+
+def load_generator(send, ifm_shape, requests=256, concurrency=16, seed=0):
+    """ Issue requests random IFM volumes of ifm_shape from concurrency
+    threads through send(ifm) and return the request latency percentiles
+    and the requests per second """
+    rng = np.random.RandomState(seed)
+    ifms = rng.randint(-128, 128, (min(requests, 64),) + tuple(ifm_shape),
+                       dtype='int%d' % C_MAX_INPUT_WIDTH)
+
+    def one(i):
+        start = time.perf_counter()
+        send(ifms[i % len(ifms)])
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as clients:
+        latencies = np.array(list(clients.map(one, range(requests))))
+    elapsed = time.perf_counter() - start
+    p50, p90, p99 = np.percentile(latencies, (50, 90, 99))
+    return {'requests': requests, 'concurrency': concurrency,
+            'requests_per_second': requests / elapsed,
+            'latency_p50': float(p50), 'latency_p90': float(p90),
+            'latency_p99': float(p99)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Darius inference server and load generator")
+    commands = parser.add_subparsers(dest='command')
+    serve = commands.add_parser('serve', help="serve a model")
+    serve.add_argument('--model', required=True, help=".npz model")
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8080)
+    serve.add_argument('--max-batch', type=int, default=DEFAULT_MAX_BATCH)
+    serve.add_argument('--max-delay', type=float, default=DEFAULT_MAX_DELAY,
+                       help="seconds a batch waits to fill")
+    serve.add_argument('--software', action='store_true',
+                       help="run on the CPU instead of the overlay")
+    load = commands.add_parser('load', help="load a running server")
+    load.add_argument('--url', default='http://127.0.0.1:8080')
+    load.add_argument('--shape', required=True,
+                      help="IFM shape as depth,height,width")
+    load.add_argument('--requests', type=int, default=256)
+    load.add_argument('--concurrency', type=int, default=16)
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        layers, weights = load_model(args.model)
+        if args.software:
+            backend = SoftwareBackend(layers, weights)
+        else:
+            from ..overlays import Convolution
+            overlay = Convolution()
+            backend = AcceleratorBackend(overlay.cnn, layers, weights,
+                                         overlay.pool, args.max_batch)
+        batcher = DynamicBatcher(backend, args.max_batch, args.max_delay)
+        server = InferenceServer(batcher, args.host, args.port)
+        print("Serving on http://%s:%d" % (args.host, args.port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+        batcher.shutdown()
+    elif args.command == 'load':
+        shape = tuple(int(dim) for dim in args.shape.split(','))
+        result = load_generator(lambda ifm_sw: infer(args.url, ifm_sw),
+                                shape, args.requests, args.concurrency)
+        print(json.dumps(result, indent=1))
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,203 @@
+#   Copyright (c) 2018, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import copy
+import time
+import numpy as np
+from .darius_lib import Darius, IP_CMD_LENGTH, IP_STATE_DONE
+from .darius_lib import CYCLE_COUNT_OFFSET, C_MAX_INPUT_WIDTH
+from .darius_lib import C_NUM_OF_ROWS, C_NUM_OF_COLS, IP_start
+from .buffer_pool import BufferPool, NamedBuffers
+
+__author__ = ""
+__copyright__ = "Copyright 2018, Xilinx"
+__email__ = "pynq_support@xilinx.com"
+
+
+class ShardedLayer(object):
+    """ A Darius layer whose output channels are split by OFM slices into
+    shards, one command per CNNDataflow instance
+
+    Every shard reads the whole IFM and a contiguous part of the packed
+    weights, since the weights of an OFM slice are contiguous in the
+    hardware layout, and writes its OFM slices straight into their place
+    in the OFM of the whole layer, so the OFM is unpacked like the one of
+    layer without a gather copy. The instances have to share the memory
+    the buffers are in """
+
+    def __init__(self, layer, shards):
+        self.layer = layer
+        shards = max(min(shards, layer.ofm_slices), 1)
+        bounds = np.linspace(0, layer.ofm_slices, shards + 1).astype(int)
+        self.slices = list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+        word = C_MAX_INPUT_WIDTH // 8
+        ofm_slice_length = layer.ofm_packet_length // layer.ofm_slices * \
+            C_NUM_OF_COLS
+        self.shards = []
+        for first, last in self.slices:
+            shard = Darius(layer.ifm_height, layer.ifm_width,
+                           layer.ifm_depth, layer.kernel_height,
+                           layer.kernel_width, layer.pad, layer.stride,
+                           (last - first) * C_NUM_OF_COLS,
+                           layer.pool_kernel_height, layer.pool_kernel_width,
+                           layer.pool_stride, layer.ifm_baseaddr,
+                           layer.weights_baseaddr +
+                           first * layer.weight_depth_offset * word,
+                           layer.ofm_baseaddr +
+                           first * ofm_slice_length * word)
+            self.shards.append(shard)
+
+    def ofm_shape(self):
+        return self.layer.ofm_shape()
+
+    def IP_cmd(self):
+        """ Command of every shard, or False if one is not supported """
+        cmds = [shard.IP_cmd() for shard in self.shards]
+        if any(cmd is False for cmd in cmds):
+            return False
+        return cmds
+
+
+class ShardScheduler(object):
+    """ Runs layers split by output channels across several CNNDataflow
+    instances in one memory space, such as several IPs of an overlay or
+    several VirtualCNNDataflow on one VirtualMemory
+
+    devices are the register interfaces (MMIO) of the instances. The
+    shards are started on all instances before any is waited for, and the
+    IFM, weights and OFM buffers are shared by the shards """
+
+    def __init__(self, devices, pool=None, min_poll=1e-5, max_poll=1e-3):
+        self.devices = list(devices)
+        self.pool = pool if pool is not None else BufferPool()
+        self.min_poll = min_poll
+        self.max_poll = max_poll
+        self.hw_cycles = []
+        self._buffers = NamedBuffers(self.pool)
+
+    def _wait_all(self, devices):
+        """ Poll every started instance until all are done; returns their
+        cycle counts """
+        cycles = [None] * len(devices)
+        delay = self.min_poll
+        while None in cycles:
+            for i, cnn in enumerate(devices):
+                if cycles[i] is None and cnn.read(0x0) == IP_STATE_DONE:
+                    cycles[i] = cnn.read(CYCLE_COUNT_OFFSET, 4)
+            if None in cycles:
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_poll)
+        return cycles
+
+    def _pack(self, layer, ifm_sw, weights_sw):
+        """ Pack the IFM and weights of layer into the shared buffers;
+        returns a copy of layer pointing at them """
+        ifm = self._buffers.get('ifm',
+                                layer.ifm_packet_length * C_NUM_OF_ROWS)
+        weights = self._buffers.get('weights', layer.weight_depth_offset *
+                                    layer.ofm_slices)
+        ofm = self._buffers.get('ofm',
+                                layer.ofm_packet_length * C_NUM_OF_COLS)
+        layer.reshape_and_copy_ifm(ifm_sw, ifm)
+        layer.reshape_and_copy_weights(weights_sw, weights)
+        ifm.flush()
+        weights.flush()
+
+        hw_layer = copy.copy(layer)
+        hw_layer.ifm_baseaddr = ifm.physical_address
+        hw_layer.weights_baseaddr = weights.physical_address
+        hw_layer.ofm_baseaddr = ofm.physical_address
+        return hw_layer
+
+    def _load(self, hw_layer, instances):
+        """ Write the shard commands of hw_layer for the first instances
+        devices; returns the devices that get a shard """
+        devices = self.devices[:instances]
+        cmds = ShardedLayer(hw_layer, len(devices)).IP_cmd()
+        if cmds is False:
+            raise ValueError("Layer is not supported by the CNNDataflow IP")
+        cmd = self._buffers.get('cmd', len(cmds) * IP_CMD_LENGTH, np.uint8)
+        for i, shard_cmd in enumerate(cmds):
+            cmd[i * IP_CMD_LENGTH:(i + 1) * IP_CMD_LENGTH] = \
+                np.frombuffer(shard_cmd, np.uint8)
+        cmd.flush()
+        return devices[:len(cmds)]
+
+    def _execute(self, layer, started, **unpack_args):
+        """ Start the loaded shards, wait for all of them and unpack the
+        OFM """
+        cmd = self._buffers['cmd']
+        for i, cnn in enumerate(started):
+            if not IP_start(cnn, cmd.physical_address + i * IP_CMD_LENGTH):
+                self._wait_all(started[:i])
+                raise RuntimeError("CNNDataflow IP %d busy" % i)
+        self.hw_cycles = self._wait_all(started)
+        ofm = self._buffers['ofm']
+        ofm.invalidate()
+        out = np.empty(layer.ofm_shape(), dtype=ofm.dtype)
+        return layer.unpack_ofm(ofm, out=out, **unpack_args)
+
+    def run(self, layer, ifm_sw, weights_sw, instances=None, **unpack_args):
+        """ Run layer on a row-major IFM volume across the first instances
+        devices, all by default, and return the row-major OFM volume,
+        unpacked with Darius.unpack_ofm(**unpack_args) """
+        hw_layer = self._pack(layer, ifm_sw, weights_sw)
+        started = self._load(hw_layer, instances)
+        return self._execute(layer, started, **unpack_args)
+
+    def scaling(self, layer, ifm_sw, weights_sw, repeat=3):
+        """ Time layer on 1 to len(devices) instances; returns for every
+        count the best wall time, the largest shard cycle count, and the
+        speedup and efficiency (speedup / instances) over one instance
+
+        The IFM and weights are packed once and the commands loaded before
+        the timing, so the wall time only covers the starts, the waits and
+        the unpack """
+        hw_layer = self._pack(layer, ifm_sw, weights_sw)
+        report = []
+        for instances in range(1, len(self.devices) + 1):
+            started = self._load(hw_layer, instances)
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                self._execute(layer, started)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            report.append({'instances': instances, 'seconds': best,
+                           'hw_cycles': max(self.hw_cycles)})
+        for entry in report:
+            speedup = report[0]['seconds'] / entry['seconds']
+            entry['speedup'] = speedup
+            entry['efficiency'] = speedup / entry['instances']
+            entry['hw_speedup'] = report[0]['hw_cycles'] / entry['hw_cycles']
+        return report
+
+    def freebuffer(self):
+        self._buffers.freebuffer()
@@ -0,0 +1,394 @@
+#   Copyright (c) 2018, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import numpy as np
+from math import ceil
+from .darius_lib import Darius, C_MAX_INPUT_WIDTH
+from .darius_lib import C_NUM_OF_ROWS, C_NUM_OF_COLS, _hw_view
+from .darius_lib import pack_slices, pack_weights
+from .program import Program
+from .trace import traced
+from .reference import maxpool_hwc
+
+__author__ = ""
+__copyright__ = "Copyright 2018, Xilinx"
+__email__ = "pynq_support@xilinx.com"
+
+# Limits of a single CNNDataflow IP command, see Darius.IP_cmd
+MAX_TILE_DIMENSION = 32
+MIN_TILE_DIMENSION = 6
+MIN_TILE_OFM_DIMENSION = 4
+MIN_POOL_OUTPUT_DIMENSION = 6
+MAX_CHANNELS = 512
+MAX_KERNEL_DIMENSION = 16
+STRIDES = (1, 2, 4)
+MAX_BTT = 1 << 23
+
+
+class _AxisTile(object):
+    """ One tile along the height or width axis
+
+    The command reads ifm_size rows starting at ifm_start (unpadded IFM
+    coordinates, out of range rows are packed as zeros) and writes
+    computed rows, of which the first needed rows land at out_start of
+    the stitched output """
+
+    def __init__(self, out_start, needed, computed, ifm_start, ifm_size):
+        self.out_start = out_start
+        self.needed = needed
+        self.computed = computed
+        self.ifm_start = ifm_start
+        self.ifm_size = ifm_size
+
+
+def _balanced_split(size, max_size):
+    """ Split size into the fewest near-equal parts of at most max_size """
+    parts = -(-size // max_size)
+    base, extra = divmod(size, parts)
+    sizes = [base + 1] * extra + [base] * (parts - extra)
+    starts = np.cumsum([0] + sizes[:-1]).tolist()
+    return list(zip(starts, sizes))
+
+
+def _plan_axis(kernel, pad, stride, ofm_size):
+    """ Tiles over the convolution output of one axis """
+    max_ofm = (MAX_TILE_DIMENSION - kernel) // stride + 1
+    min_ofm = max(MIN_TILE_OFM_DIMENSION,
+                  -(-(MIN_TILE_DIMENSION - kernel) // stride) + 1)
+    tiles = []
+    for start, needed in _balanced_split(ofm_size, max_ofm):
+        computed = max(needed, min_ofm)
+        tiles.append(_AxisTile(start, needed, computed,
+                               start * stride - pad,
+                               (computed - 1) * stride + kernel))
+    return tiles
+
+
+def _plan_pooled_axis(kernel, pad, stride, ofm_size,
+                      pool_kernel, pool_stride, pool_size):
+    """ Tiles over the maxpool output of one axis, or None if the IP cannot
+    pool this axis within the tile limits """
+    max_pool = ((MAX_TILE_DIMENSION - kernel) // stride + 1 - pool_kernel) \
+        // pool_stride + 1
+    if max_pool < MIN_POOL_OUTPUT_DIMENSION:
+        return None
+    tiles = []
+    for start, needed in _balanced_split(pool_size, max_pool):
+        if needed < MIN_POOL_OUTPUT_DIMENSION:
+            return None
+        ofm_start = start * pool_stride
+        # Clip at the end of the convolution output so the last pooling
+        # windows only cover valid rows, as for the untiled layer
+        ofm_count = min((needed - 1) * pool_stride + pool_kernel,
+                        ofm_size - ofm_start)
+        tiles.append(_AxisTile(start, needed, needed,
+                               ofm_start * stride - pad,
+                               (ofm_count - 1) * stride + kernel))
+    return tiles
+
+
+class TiledLayer(object):
+    """ Convolution with Maxpool of any IFM size, depth and channel count,
+    split into commands the CNNDataflow IP accepts
+
+    The output plane is split into tiles whose IFM, including the halo and
+    any padding, fits the IP's IFM limits; padding is packed as zeros so
+    every command runs with pad 0. Output channels are split into groups
+    within MAX_CHANNELS and the datamover BTT limit. IFM depths over
+    MAX_CHANNELS are split into depth groups whose 16-bit partial sums are
+    accumulated on the host in 32 bits; depths that are not multiples of 8
+    are zero padded to full slices by the packers. When the maxpool cannot
+    be run per tile on the IP, or there are several depth groups, it is
+    applied on the host after the tiles are stitched and accumulated.
+    Unlike a single Darius command the maxpool is always applied when
+    pool_stride is not 0.
+
+    The ifm, weights and ofm buffers hold ifm_length, weights_length and
+    ofm_length elements from their base addresses """
+
+    def __init__(self, ifm_height, ifm_width, ifm_depth, kernel_height,
+                 kernel_width, pad, stride, channels,
+                 pool_kernel_height, pool_kernel_width, pool_stride,
+                 ifm_baseaddr, weights_baseaddr, ofm_baseaddr):
+        if channels % C_NUM_OF_COLS != 0:
+            raise ValueError("Number of channels has to be a multiple of %d"
+                             % C_NUM_OF_COLS)
+        if not (1 <= kernel_height <= MAX_KERNEL_DIMENSION and
+                1 <= kernel_width <= MAX_KERNEL_DIMENSION):
+            raise ValueError("Kernel of %dx%d is not in the range 1 to %d"
+                             % (kernel_height, kernel_width,
+                                MAX_KERNEL_DIMENSION))
+        if stride not in STRIDES:
+            raise ValueError("Stride %d is not one of %s"
+                             % (stride, ", ".join(map(str, STRIDES))))
+        self.ifm_height = ifm_height
+        self.ifm_width = ifm_width
+        self.ifm_depth = ifm_depth
+        self.kernel_height = kernel_height
+        self.kernel_width = kernel_width
+        self.pad = pad
+        self.stride = stride
+        self.channels = channels
+        self.pool_kernel_height = pool_kernel_height
+        self.pool_kernel_width = pool_kernel_width
+        self.pool_stride = pool_stride
+        self.ifm_baseaddr = ifm_baseaddr
+        self.weights_baseaddr = weights_baseaddr
+        self.ofm_baseaddr = ofm_baseaddr
+
+        self.ofm_height = ceil((ifm_height + 2 * pad - kernel_height) /
+                               stride + 1)
+        self.ofm_width = ceil((ifm_width + 2 * pad - kernel_width) /
+                              stride + 1)
+        if pool_stride != 0:
+            self.pool_output_height = ceil((self.ofm_height -
+                                            pool_kernel_height) /
+                                           pool_stride + 1)
+            self.pool_output_width = ceil((self.ofm_width -
+                                           pool_kernel_width) /
+                                          pool_stride + 1)
+        else:
+            self.pool_output_height = 0
+            self.pool_output_width = 0
+        self._plan()
+
+    def _plan(self):
+        # Depth groups of whole slices; the last one may be partial
+        self.depth_groups = [
+            (start * C_NUM_OF_ROWS,
+             min(size * C_NUM_OF_ROWS, self.ifm_depth - start * C_NUM_OF_ROWS))
+            for start, size in _balanced_split(
+                -(-self.ifm_depth // C_NUM_OF_ROWS),
+                MAX_CHANNELS // C_NUM_OF_ROWS)]
+
+        # Partial sums can only be pooled after they are accumulated
+        rows = cols = None
+        if self.pool_stride != 0 and len(self.depth_groups) == 1:
+            rows = _plan_pooled_axis(self.kernel_height,
+                                     self.pad, self.stride, self.ofm_height,
+                                     self.pool_kernel_height,
+                                     self.pool_stride,
+                                     self.pool_output_height)
+            cols = _plan_pooled_axis(self.kernel_width,
+                                     self.pad, self.stride, self.ofm_width,
+                                     self.pool_kernel_width,
+                                     self.pool_stride,
+                                     self.pool_output_width)
+        self.host_pool = self.pool_stride != 0 and (rows is None or
+                                                   cols is None)
+        if rows is None or cols is None:
+            rows = _plan_axis(self.kernel_height, self.pad,
+                              self.stride, self.ofm_height)
+            cols = _plan_axis(self.kernel_width, self.pad,
+                              self.stride, self.ofm_width)
+        ip_pool = self.pool_stride != 0 and not self.host_pool
+
+        # Output channel groups within the channel and BTT limits
+        ofm_plane = max(((row.computed - 1) * self.pool_stride +
+                         self.pool_kernel_height if ip_pool else row.computed)
+                        for row in rows) * \
+            max(((col.computed - 1) * self.pool_stride +
+                 self.pool_kernel_width if ip_pool else col.computed)
+                for col in cols)
+        max_group = MAX_BTT // (ofm_plane * (C_MAX_INPUT_WIDTH // 8))
+        max_group = min(MAX_CHANNELS, max_group - max_group % C_NUM_OF_COLS)
+        self.groups = _balanced_split(self.channels // C_NUM_OF_COLS,
+                                      max_group // C_NUM_OF_COLS)
+        self.groups = [(start * C_NUM_OF_COLS, size * C_NUM_OF_COLS)
+                       for start, size in self.groups]
+
+        kernel_size = self.kernel_height * self.kernel_width
+        self.weights_offsets = {}
+        offset = 0
+        for group, (_, size) in enumerate(self.groups):
+            for depth_group, (_, depth) in enumerate(self.depth_groups):
+                self.weights_offsets[group, depth_group] = offset
+                offset += size * kernel_size * \
+                    -(-depth // C_NUM_OF_ROWS) * C_NUM_OF_ROWS
+        self.weights_length = offset
+
+        self._plan_tiles(rows, cols, ip_pool)
+
+    def _plan_tiles(self, rows, cols, ip_pool):
+        """ The Darius command of every tile, depth group and channel
+        group, with its IFM and OFM laid out back to back """
+        word = C_MAX_INPUT_WIDTH // 8
+        self.tiles = []
+        self.layers = []
+        ifm_offset = ofm_offset = 0
+        for row in rows:
+            for col in cols:
+                for depth_group, (_, depth) in enumerate(self.depth_groups):
+                    tile_ifm = ifm_offset
+                    ifm_offset += row.ifm_size * col.ifm_size * \
+                        -(-depth // C_NUM_OF_ROWS) * C_NUM_OF_ROWS
+                    for group, (_, size) in enumerate(self.groups):
+                        layer = Darius(
+                            row.ifm_size, col.ifm_size, depth,
+                            self.kernel_height, self.kernel_width, 0,
+                            self.stride, size,
+                            self.pool_kernel_height if ip_pool else 0,
+                            self.pool_kernel_width if ip_pool else 0,
+                            self.pool_stride if ip_pool else 0,
+                            self.ifm_baseaddr + tile_ifm * word,
+                            self.weights_baseaddr +
+                            self.weights_offsets[group, depth_group] * word,
+                            self.ofm_baseaddr + ofm_offset * word,
+                            verbose=False)
+                        if ip_pool and layer.pool_stride == 0:
+                            raise RuntimeError("Tile maxpool was disabled by "
+                                               "the IP limits")
+                        self.tiles.append((row, col, depth_group, group,
+                                           ofm_offset))
+                        self.layers.append(layer)
+                        ofm_offset += layer.ofm_packet_length * C_NUM_OF_COLS
+        self.ifm_length = ifm_offset
+        self.ofm_length = ofm_offset
+        self._rows = rows
+        self._cols = cols
+
+    @property
+    def num_commands(self):
+        return len(self.layers)
+
+    def ofm_shape(self):
+        """ Shape (channels, height, width) of the stitched output """
+        if self.pool_stride != 0:
+            return (self.channels, self.pool_output_height,
+                    self.pool_output_width)
+        return (self.channels, self.ofm_height, self.ofm_width)
+
+    def program(self):
+        """ Program holding every tile command, run with one IP start """
+        program = Program()
+        for layer in self.layers:
+            program.add(layer, chain=False)
+        return program
+
+    def IP_cmd(self):
+        """ Concatenated commands of all tiles """
+        return self.program().IP_cmd()
+
+    @traced('pack_ifm')
+    def reshape_and_copy_ifm(self, ifm_sw, ifm):
+        """ Pack the halo tiles of a row-major IFM volume to physical memory
+        with ifm pointer; each tile is copied straight from the volume """
+        src = np.asarray(ifm_sw).reshape(self.ifm_depth, self.ifm_height,
+                                         self.ifm_width)
+        offset = 0
+        for row in self._rows:
+            for col in self._cols:
+                r0 = max(row.ifm_start, 0)
+                r1 = min(row.ifm_start + row.ifm_size, self.ifm_height)
+                c0 = max(col.ifm_start, 0)
+                c1 = min(col.ifm_start + col.ifm_size, self.ifm_width)
+                halo = (r0, r1, c0, c1) != (row.ifm_start,
+                                            row.ifm_start + row.ifm_size,
+                                            col.ifm_start,
+                                            col.ifm_start + col.ifm_size)
+                for start, depth in self.depth_groups:
+                    slices = -(-depth // C_NUM_OF_ROWS)
+                    dst = _hw_view(ifm[offset:], (slices, row.ifm_size,
+                                                  col.ifm_size,
+                                                  C_NUM_OF_ROWS))
+                    offset += dst.size
+                    if halo:
+                        dst[...] = 0
+                    if r0 >= r1 or c0 >= c1:
+                        continue
+                    pack_slices(src[start:start + depth, r0:r1, c0:c1],
+                                dst[:, r0 - row.ifm_start:r1 - row.ifm_start,
+                                    c0 - col.ifm_start:c1 - col.ifm_start])
+
+    @traced('pack_weights')
+    def reshape_and_copy_weights(self, weights_sw, weights):
+        """ Pack the weights of every output channel group to physical
+        memory with weights pointer """
+        kernel_size = self.kernel_height * self.kernel_width
+        src = np.asarray(weights_sw).reshape(self.channels, self.ifm_depth,
+                                             kernel_size)
+        for group, (start, size) in enumerate(self.groups):
+            for depth_group, (first, depth) in enumerate(self.depth_groups):
+                dst = _hw_view(
+                    weights[self.weights_offsets[group, depth_group]:],
+                    (size // C_NUM_OF_COLS, -(-depth // C_NUM_OF_ROWS),
+                     kernel_size, C_NUM_OF_ROWS, C_NUM_OF_COLS))
+                pack_weights(src[start:start + size, first:first + depth],
+                             dst)
+
+    @traced('unpack')
+    def unpack_ofm(self, ofm, out=None):
+        """ Stitch the OFM tiles in physical memory into a row-major
+        (channels, height, width) volume, writing each tile straight into
+        place; depth group partial sums are added into a 32-bit
+        accumulator and the host maxpool runs after stitching when it is
+        needed. The result wraps to the out dtype like the IP output """
+        shape = self.ofm_shape()
+        if out is None:
+            out = np.empty(shape, dtype=ofm.dtype)
+        elif out.shape != shape:
+            raise ValueError("OFM output buffer has shape %s, expected %s"
+                             % (out.shape, shape))
+        stitched = out
+        if len(self.depth_groups) > 1:
+            stitched = np.empty((self.channels, self.ofm_height,
+                                 self.ofm_width), dtype=np.int32)
+        elif self.host_pool:
+            stitched = np.empty((self.channels, self.ofm_height,
+                                 self.ofm_width), dtype=out.dtype)
+
+        for layer, (row, col, depth_group, group, offset) in \
+                zip(self.layers, self.tiles):
+            start, size = self.groups[group]
+            _, height, width = layer.ofm_shape()
+            hw = _hw_view(ofm[offset:], (size // C_NUM_OF_COLS, height,
+                                         width, C_NUM_OF_COLS))
+            hw = hw[:, :row.needed, :col.needed].transpose(0, 3, 1, 2)
+            dst = stitched[start:start + size,
+                           row.out_start:row.out_start + row.needed,
+                           col.out_start:col.out_start + col.needed]
+            dst = dst.reshape(size // C_NUM_OF_COLS, C_NUM_OF_COLS,
+                              row.needed, col.needed)
+            if depth_group == 0:
+                np.copyto(dst, hw, casting='unsafe')
+            else:
+                np.add(dst, hw, out=dst, casting='unsafe')
+
+        if self.host_pool:
+            pooled = maxpool_hwc(stitched.astype(out.dtype, copy=False)
+                                 .transpose(1, 2, 0),
+                                 self.pool_kernel_height,
+                                 self.pool_kernel_width, self.pool_stride,
+                                 self.pool_output_height,
+                                 self.pool_output_width)
+            np.copyto(out, pooled.transpose(2, 0, 1), casting='unsafe')
+        elif stitched is not out:
+            np.copyto(out, stitched, casting='unsafe')
+        return out
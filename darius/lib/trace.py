@@ -0,0 +1,173 @@
+#   Copyright (c) 2018, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+import numpy as np
+
+__author__ = ""
+__copyright__ = "Copyright 2018, Xilinx"
+__email__ = "pynq_support@xilinx.com"
+
+# Stages timed by the darius code paths
+TRACE_STAGES = ('pack_ifm', 'pack_weights', 'build_cmd', 'submit', 'wait',
+                'unpack')
+
+# The active Tracer, or None when tracing is off
+_tracer = None
+
+
+def _now_ns():
+    """ perf_counter() in integer nanoseconds; perf_counter_ns() needs
+    Python 3.7 """
+    return int(time.perf_counter() * 1e9)
+
+
+class Tracer(object):
+    """ Collects the time spans of the traced stages of all threads
+
+    Every span is kept as (stage, start, duration, thread id, hardware
+    cycles) with times in nanoseconds; the cycle count is only known for
+    the wait stage """
+
+    def __init__(self):
+        self.events = []
+        self.origin = _now_ns()
+
+    def record(self, stage, start, duration, hw_cycles=None):
+        # list.append is atomic, so threads need no lock here
+        self.events.append((stage, start, duration, threading.get_ident(),
+                            hw_cycles))
+
+    def clear(self):
+        self.events = []
+
+    def chrome_trace(self):
+        """ The spans as a Chrome trace_event document, to be opened with
+        chrome://tracing or Perfetto """
+        pid = os.getpid()
+        events = []
+        for stage, start, duration, tid, hw_cycles in list(self.events):
+            event = {'name': stage, 'cat': 'darius', 'ph': 'X',
+                     'ts': (start - self.origin) / 1e3,
+                     'dur': duration / 1e3, 'pid': pid, 'tid': tid}
+            if hw_cycles is not None:
+                event['args'] = {'hw_cycles': hw_cycles}
+            events.append(event)
+        return {'traceEvents': events, 'displayTimeUnit': 'ns'}
+
+    def export_chrome_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+    def summary(self):
+        """ Per stage count, total, mean, p50 and p99 wall time in
+        microseconds, and for the wait stage the mean hardware cycles """
+        events = list(self.events)
+        result = {}
+        for stage in sorted(set(event[0] for event in events)):
+            durations = np.array([event[2] for event in events
+                                  if event[0] == stage]) / 1e3
+            p50, p99 = np.percentile(durations, (50, 99))
+            stats = {'count': len(durations),
+                     'total_us': float(durations.sum()),
+                     'mean_us': float(durations.mean()),
+                     'p50_us': float(p50), 'p99_us': float(p99)}
+            cycles = [event[4] for event in events
+                      if event[0] == stage and event[4] is not None]
+            if cycles:
+                stats['mean_hw_cycles'] = float(np.mean(cycles))
+            result[stage] = stats
+        return result
+
+    def summary_table(self):
+        """ summary() as a text table """
+        lines = ["%-14s %8s %12s %10s %10s %10s %14s"
+                 % ('stage', 'count', 'total us', 'mean us', 'p50 us',
+                    'p99 us', 'hw cycles')]
+        for stage, stats in self.summary().items():
+            cycles = stats.get('mean_hw_cycles')
+            lines.append("%-14s %8d %12.1f %10.1f %10.1f %10.1f %14s"
+                         % (stage, stats['count'], stats['total_us'],
+                            stats['mean_us'], stats['p50_us'],
+                            stats['p99_us'],
+                            '' if cycles is None else '%.0f' % cycles))
+        return "\n".join(lines)
+
+
+def enable_tracing(tracer=None):
+    """ Turn tracing on, into tracer or a new Tracer, and return it """
+    global _tracer
+    _tracer = tracer if tracer is not None else Tracer()
+    return _tracer
+
+
+def disable_tracing():
+    """ Turn tracing off and return the Tracer that was active """
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+
+@contextlib.contextmanager
+def tracing(tracer=None):
+    """ Trace the darius code paths within a with block """
+    previous = _tracer
+    tracer = enable_tracing(tracer)
+    try:
+        yield tracer
+    finally:
+        if previous is not None:
+            enable_tracing(previous)
+        else:
+            disable_tracing()
+
+
+def traced(stage, hw_cycles=False):
+    """ Decorator timing each call as a span of stage when tracing is on;
+    with hw_cycles the return value is recorded as the hardware cycle
+    count. When tracing is off the only cost is a global lookup """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            tracer = _tracer
+            if tracer is None:
+                return func(*args, **kwargs)
+            start = _now_ns()
+            result = func(*args, **kwargs)
+            tracer.record(stage, start, _now_ns() - start,
+                          result if hw_cycles else None)
+            return result
+        return wrapper
+    return decorate
@@ -0,0 +1,296 @@
+#   Copyright (c) 2018, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import threading
+import time
+import numpy as np
+from .darius_lib import C_MAX_INPUT_WIDTH, C_NUM_OF_ROWS, C_NUM_OF_COLS
+from .darius_lib import CNNDATAFLOW_BASEADDR, CNNDATAFLOW_ADDR_RANGE
+from .darius_lib import NUM_COMMANDS_OFFSET, CMD_BASEADDR_OFFSET
+from .darius_lib import CYCLE_COUNT_OFFSET, IP_START, IP_STATE_IDLE
+from .darius_lib import IP_STATE_DONE, IP_CMD_LENGTH, parse_IP_cmd
+from .reference import run_IP_cmd
+
+__author__ = ""
+__copyright__ = "Copyright 2018, Xilinx"
+__email__ = "pynq_support@xilinx.com"
+
+VIRTUAL_CMA_BASEADDR = 0x16000000
+VIRTUAL_CMA_ALIGNMENT = 4096
+
+
+class VirtualBuffer(np.ndarray):
+    """ NumPy array carved out of a VirtualMemory, mirroring the
+    physical_address/freebuffer interface of the Xlnk cma_array """
+
+    def freebuffer(self):
+        memory = getattr(self, 'memory', None)
+        if memory is not None:
+            memory.free(self.physical_address)
+            self.memory = None
+
+    def flush(self):
+        pass
+
+    def invalidate(self):
+        pass
+
+
+class VirtualMemory(object):
+    """ In-process stand-in for the CMA memory shared by the PS and the PL
+
+    Buffers are handed out with cma_array() like Xlnk and carry a physical
+    address into one flat memory map, which the virtual devices read and
+    write through view() """
+
+    def __init__(self, size=128 << 20, base_address=VIRTUAL_CMA_BASEADDR):
+        self.size = size
+        self.base_address = base_address
+        self._store = np.zeros(size, dtype=np.uint8)
+        self._lock = threading.Lock()
+        self._free = [(0, size)]
+        self._allocated = {}
+
+    def cma_array(self, shape, dtype=np.uint32):
+        """ Allocate a contiguous array and return it as a VirtualBuffer """
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape))
+        nbytes = max(count * dtype.itemsize, 1)
+        nbytes = -(-nbytes // VIRTUAL_CMA_ALIGNMENT) * VIRTUAL_CMA_ALIGNMENT
+        with self._lock:
+            for i, (start, length) in enumerate(self._free):
+                if length >= nbytes:
+                    break
+            else:
+                raise RuntimeError("Failed to allocate memory!")
+            if length == nbytes:
+                del self._free[i]
+            else:
+                self._free[i] = (start + nbytes, length - nbytes)
+            self._allocated[start] = nbytes
+
+        raw = self._store[start:start + count * dtype.itemsize]
+        buf = raw.view(dtype).reshape(shape).view(VirtualBuffer)
+        buf.physical_address = self.base_address + start
+        buf.virtual_address = buf.ctypes.data
+        buf.memory = self
+        return buf
+
+    def free(self, physical_address):
+        """ Return the buffer at physical_address to the memory map """
+        start = physical_address - self.base_address
+        with self._lock:
+            nbytes = self._allocated.pop(start)
+            self._free.append((start, nbytes))
+            self._free.sort()
+            merged = [self._free[0]]
+            for extent_start, length in self._free[1:]:
+                last_start, last_length = merged[-1]
+                if last_start + last_length == extent_start:
+                    merged[-1] = (last_start, last_length + length)
+                else:
+                    merged.append((extent_start, length))
+            self._free = merged
+
+    def cma_stats(self):
+        """ Memory statistics in the format of Xlnk.cma_stats() """
+        with self._lock:
+            available = sum(length for _, length in self._free)
+            return {'CMA Memory Available': available,
+                    'CMA Memory Usage': self.size - available,
+                    'Buffer Count': len(self._allocated)}
+
+    def xlnk_reset(self):
+        """ Release every buffer allocated from the memory map """
+        with self._lock:
+            self._free = [(0, self.size)]
+            self._allocated = {}
+
+    def view(self, physical_address, count, dtype=np.uint8):
+        """ Array view of count elements at a physical address """
+        dtype = np.dtype(dtype)
+        start = physical_address - self.base_address
+        end = start + count * dtype.itemsize
+        if start < 0 or end > self.size:
+            raise ValueError("Address range 0x%x-0x%x is outside the memory "
+                             "map" % (physical_address,
+                                      physical_address + end - start))
+        return self._store[start:end].view(dtype)
+
+    def mmio(self, base_addr, length):
+        """ MMIO style accessor for a region of the memory map """
+        return VirtualMMIO(self, base_addr, length)
+
+
+class VirtualMMIO(object):
+    """ Drop-in for pynq.MMIO over a region of a VirtualMemory """
+
+    def __init__(self, memory, base_addr, length=4):
+        self.memory = memory
+        self.base_addr = base_addr
+        self.length = length
+        self.array = memory.view(base_addr, length // 4, np.uint32)
+
+    def read(self, offset=0, length=4):
+        data = self.memory.view(self.base_addr + offset, length)
+        return int.from_bytes(data.tobytes(), 'little')
+
+    def write(self, offset, data):
+        if isinstance(data, int):
+            data = data.to_bytes(4, 'little')
+        data = np.frombuffer(bytes(data), dtype=np.uint8)
+        self.memory.view(self.base_addr + offset, data.size)[:] = data
+
+
+def ideal_cycles(cmd):
+    """ Cycle count of a parsed command on a fully utilized PE array """
+    return cmd['ofm_height'] * cmd['ofm_width'] * \
+        cmd['ofm_slices'] * C_NUM_OF_COLS * \
+        cmd['kernel_height'] * cmd['kernel_width'] * \
+        cmd['ifm_slices'] * C_NUM_OF_ROWS // (C_NUM_OF_ROWS * C_NUM_OF_COLS)
+
+
+class VirtualCNNDataflow(object):
+    """ Register level model of the CNNDataflow IP
+
+    Has the read/write interface of the pynq.MMIO the notebook opens at
+    CNNDATAFLOW_BASEADDR. Writing IP_START to register 0x0 while the IP is
+    idle fetches NUM_COMMANDS_OFFSET commands from CMD_BASEADDR_OFFSET and
+    runs them with the reference engine on a background thread; the state
+    register then reads IP_STATE_DONE once (clear on read) and
+    CYCLE_COUNT_OFFSET holds the cycles of the run. A run whose commands
+    fail never reaches IP_STATE_DONE: the next read of the state register,
+    or wait(), raises a RuntimeError from the failure and returns the
+    device to idle.
+
+    cycle_model maps a parsed command to its cycle count; when clock_mhz is
+    set the device also takes that long in wall time """
+
+    def __init__(self, memory, base_addr=CNNDATAFLOW_BASEADDR,
+                 length=CNNDATAFLOW_ADDR_RANGE, cycle_model=ideal_cycles,
+                 clock_mhz=None):
+        self.memory = memory
+        self.base_addr = base_addr
+        self.length = length
+        self.cycle_model = cycle_model
+        self.clock_mhz = clock_mhz
+        self.commands_run = 0
+        self.error = None
+        self._registers = {0x0: IP_STATE_IDLE}
+        self._lock = threading.Lock()
+        self._start = threading.Condition(self._lock)
+        self._done = threading.Event()
+        self._done.set()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _raise_error(self):
+        error, self.error = self.error, None
+        self._registers[0x0] = IP_STATE_IDLE
+        raise RuntimeError("CNNDataflow run failed: %s" % error) from error
+
+    def read(self, offset=0, length=4):
+        with self._lock:
+            if offset == 0x0 and self.error is not None:
+                self._raise_error()
+            value = self._registers.get(offset, 0)
+            if offset == 0x0 and value == IP_STATE_DONE:
+                self._registers[0x0] = IP_STATE_IDLE
+            return value
+
+    def write(self, offset, data):
+        if not isinstance(data, int):
+            data = int.from_bytes(bytes(data), 'little')
+        with self._lock:
+            if offset == 0x0:
+                if data & IP_START and self._registers[0x0] & IP_STATE_IDLE:
+                    self._registers[0x0] = IP_START
+                    self._done.clear()
+                    self._start.notify()
+                return
+            self._registers[offset] = data & 0xFFFFFFFF
+
+    def wait(self, timeout=None):
+        """ Block until the current run finishes, like waiting on the IP's
+        interrupt line; returns False on timeout """
+        if not self._done.wait(timeout):
+            return False
+        with self._lock:
+            if self.error is not None:
+                self._raise_error()
+        return True
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while self._registers[0x0] != IP_START:
+                    self._start.wait()
+                self._registers[0x0] = 0x0
+                num_commands = self._registers.get(NUM_COMMANDS_OFFSET, 0)
+                cmd_baseaddr = self._registers.get(CMD_BASEADDR_OFFSET, 0)
+
+            started = time.perf_counter()
+            cycles = 0
+            error = None
+            try:
+                cmds = self.memory.view(cmd_baseaddr,
+                                        num_commands * IP_CMD_LENGTH)
+                for i in range(num_commands):
+                    cmd = parse_IP_cmd(cmds, i * IP_CMD_LENGTH)
+                    self.execute(cmd)
+                    cycles += int(self.cycle_model(cmd))
+                    self.commands_run += 1
+            except Exception as e:
+                error = e
+            if self.clock_mhz:
+                remaining = cycles / (self.clock_mhz * 1e6) - \
+                    (time.perf_counter() - started)
+                if remaining > 0:
+                    time.sleep(remaining)
+
+            with self._lock:
+                self._registers[CYCLE_COUNT_OFFSET] = cycles & 0xFFFFFFFF
+                if error is None:
+                    self._registers[0x0] = IP_STATE_DONE
+                else:
+                    self.error = error
+                self._done.set()
+
+    def execute(self, cmd):
+        """ Run one parsed command against the memory map """
+        dtype = 'int%d' % C_MAX_INPUT_WIDTH
+        ifm = self.memory.view(cmd['ifm_baseaddr'],
+                               cmd['ifm_packet_length'] * C_NUM_OF_ROWS, dtype)
+        weights = self.memory.view(cmd['weights_baseaddr'],
+                                   cmd['weight_depth_offset'] *
+                                   cmd['ofm_slices'], dtype)
+        ofm = self.memory.view(cmd['ofm_baseaddr'],
+                               cmd['ofm_packet_length'] * C_NUM_OF_COLS, dtype)
+        run_IP_cmd(cmd, ifm, weights, ofm)
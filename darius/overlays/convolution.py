@@ -1,30 +1,30 @@
 #   Copyright (c) 2018, Xilinx, Inc.
 #   All rights reserved.
-# 
-#   Redistribution and use in source and binary forms, with or without 
+#
+#   Redistribution and use in source and binary forms, with or without
 #   modification, are permitted provided that the following conditions are met:
 #
-#   1.  Redistributions of source code must retain the above copyright notice, 
+#   1.  Redistributions of source code must retain the above copyright notice,
 #       this list of conditions and the following disclaimer.
 #
-#   2.  Redistributions in binary form must reproduce the above copyright 
-#       notice, this list of conditions and the following disclaimer in the 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
 #       documentation and/or other materials provided with the distribution.
 #
-#   3.  Neither the name of the copyright holder nor the names of its 
-#       contributors may be used to endorse or promote products derived from 
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
 #       this software without specific prior written permission.
 #
 #   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
-#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, 
-#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR 
-#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR 
-#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, 
-#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, 
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
 #   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
-#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, 
-#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR 
-#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF 
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
 #   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
@@ -32,9 +32,177 @@ __author__ = ""
 __copyright__ = "Copyright 2018, Xilinx"
 __email__ = ""
 
+import copy
+import os
+import time
+import weakref
+import numpy as np
 import pynq
 import pynq.lib
+from pynq import MMIO
+from ..lib.darius_lib import IP_CMD_LENGTH, CYCLE_COUNT_OFFSET
+from ..lib.darius_lib import IP_start, IP_wait
+from ..lib.darius_lib import C_NUM_OF_ROWS, C_NUM_OF_COLS
+from ..lib.buffer_pool import BufferPool, NamedBuffers
+from ..lib.executor import Executor
+from ..lib.batch import BatchedLayer
+from ..lib.packed import PackedTensor, as_ifm
+
+CONVOLUTION_BITFILE = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                   'convolution.bit')
+CNNDATAFLOW_IP_TYPE = 'cnn_dataflow'
+
 
 class Convolution(pynq.Overlay):
-	def __init__(self, bitfile, **kwargs):
-		pass
\ No newline at end of file
+    """ Convolution with Maxpool overlay
+
+    The CNNDataflow IP is looked up in the ip_dict once, and its register
+    MMIO and a command buffer stay mapped for the lifetime of the overlay,
+    so run() only packs data and writes a few registers. IFM, weights and
+    OFM buffers come from a BufferPool and are kept and grown as needed """
+
+    def __init__(self, bitfile=CONVOLUTION_BITFILE, pool=None, **kwargs):
+        super().__init__(bitfile, **kwargs)
+        for name, ip in self.ip_dict.items():
+            if CNNDATAFLOW_IP_TYPE in ip.get('type', '') or \
+                    name.startswith(CNNDATAFLOW_IP_TYPE):
+                break
+        else:
+            raise RuntimeError("No CNNDataflow IP found in the overlay")
+        self.cnn = MMIO(ip['phys_addr'], ip['addr_range'])
+        self.pool = pool if pool is not None else BufferPool()
+        self.cmd = self.pool.allocate(IP_CMD_LENGTH, np.uint8)
+        self.hw_cycles = 0
+        self.batch_stats = None
+        self._buffers = NamedBuffers(self.pool)
+        self._cmds = weakref.WeakKeyDictionary()
+
+    def _cmd(self, layer, addresses):
+        """ Command of layer on the given (ifm, weights, ofm) addresses,
+        built once; the cache entry goes with the layer """
+        cached = self._cmds.get(layer)
+        if cached is None or cached[0] != addresses:
+            hw_layer = copy.copy(layer)
+            (hw_layer.ifm_baseaddr, hw_layer.weights_baseaddr,
+             hw_layer.ofm_baseaddr) = addresses
+            cached = (addresses, hw_layer.IP_cmd())
+            self._cmds[layer] = cached
+        return cached[1]
+
+    def run(self, layer, ifm_sw, weights_sw=None, **unpack_args):
+        """ Run one Darius layer on a row-major IFM volume and return the
+        row-major OFM volume, unpacked with Darius.unpack_ofm(**unpack_args)
+
+        Without weights_sw the weights already packed at the layer's
+        weights_baseaddr are used """
+        ifm = self._buffers.get('ifm',
+                                layer.ifm_packet_length * C_NUM_OF_ROWS)
+        ofm = self._buffers.get('ofm',
+                                layer.ofm_packet_length * C_NUM_OF_COLS)
+        weights_baseaddr = layer.weights_baseaddr
+        if weights_sw is not None:
+            weights = self._buffers.get('weights',
+                                        layer.weight_depth_offset *
+                                        layer.ofm_slices)
+            layer.reshape_and_copy_weights(weights_sw, weights)
+            weights.flush()
+            weights_baseaddr = weights.physical_address
+
+        cmd = self._cmd(layer, (ifm.physical_address, weights_baseaddr,
+                                ofm.physical_address))
+        if cmd is False:
+            raise ValueError("Layer is not supported by the CNNDataflow IP")
+        layer.reshape_and_copy_ifm(ifm_sw, ifm)
+        ifm.flush()
+        self.cmd[:len(cmd)] = np.frombuffer(cmd, np.uint8)
+        self.cmd.flush()
+
+        if not IP_start(self.cnn, self.cmd.physical_address):
+            raise RuntimeError("CNNDataflow IP busy")
+        self.hw_cycles = IP_wait(self.cnn)
+        ofm.invalidate()
+        out = np.empty(layer.ofm_shape(), dtype=ofm.dtype)
+        return layer.unpack_ofm(ofm, out=out, **unpack_args)
+
+    def run_batch(self, layer, ifm_sw, weights_sw=None, **unpack_args):
+        """ Run one Darius layer on a (batch, depth, height, width) array of
+        IFM volumes with a single IP start and return the (batch, channels,
+        height, width) OFM volumes; the weights are packed once and shared
+        by every image. The throughput of the run is kept in batch_stats """
+        start = time.perf_counter()
+        batch = BatchedLayer(copy.copy(layer), len(ifm_sw))
+        ifm = self._buffers.get('ifm', batch.ifm_length)
+        ofm = self._buffers.get('ofm', batch.ofm_length)
+        if weights_sw is not None:
+            weights = self._buffers.get('weights', batch.weights_length)
+            batch.reshape_and_copy_weights(weights_sw, weights)
+            weights.flush()
+            batch.layer.weights_baseaddr = weights.physical_address
+        batch.layer.ifm_baseaddr = ifm.physical_address
+        batch.layer.ofm_baseaddr = ofm.physical_address
+
+        cmds = batch.IP_cmd()
+        if cmds is False:
+            raise ValueError("Layer is not supported by the CNNDataflow IP")
+        cmd = self._buffers.get('cmds', len(cmds), np.uint8)
+        cmd[:len(cmds)] = np.frombuffer(cmds, np.uint8)
+        cmd.flush()
+        batch.reshape_and_copy_ifm(ifm_sw, ifm)
+        ifm.flush()
+
+        if not IP_start(self.cnn, cmd.physical_address, batch.num_commands):
+            raise RuntimeError("CNNDataflow IP busy")
+        self.hw_cycles = IP_wait(self.cnn)
+        ofm.invalidate()
+        out = batch.unpack_ofm(ofm, **unpack_args)
+        self.batch_stats = batch.throughput(time.perf_counter() - start,
+                                            self.hw_cycles)
+        return out
+
+    def run_packed(self, layer, ifm, weights_sw=None, maxpool=None):
+        """ Run one Darius layer on a PackedTensor, or a row-major IFM
+        volume, and return its OFM as a PackedTensor on a buffer from the
+        pool, without unpacking it
+
+        An OFM returned by the previous layer is read by the IP in place
+        unless the layer needs another format, see as_ifm(). Tensors
+        returned are released with freebuffer() """
+        if isinstance(ifm, PackedTensor):
+            src = as_ifm(ifm, layer, self.pool, maxpool)
+        else:
+            src = PackedTensor.allocate(self.pool, layer.ifm_depth,
+                                        layer.ifm_height,
+                                        layer.ifm_width).pack(ifm)
+        if src is not ifm:
+            src.flush()
+        weights_baseaddr = layer.weights_baseaddr
+        if weights_sw is not None:
+            weights = self._buffers.get('weights',
+                                        layer.weight_depth_offset *
+                                        layer.ofm_slices)
+            layer.reshape_and_copy_weights(weights_sw, weights)
+            weights.flush()
+            weights_baseaddr = weights.physical_address
+        ofm = PackedTensor.allocate(self.pool, *layer.ofm_shape())
+
+        cmd = self._cmd(layer, (src.physical_address, weights_baseaddr,
+                                ofm.physical_address))
+        if cmd is False:
+            raise ValueError("Layer is not supported by the CNNDataflow IP")
+        self.cmd[:len(cmd)] = np.frombuffer(cmd, np.uint8)
+        self.cmd.flush()
+        if not IP_start(self.cnn, self.cmd.physical_address):
+            raise RuntimeError("CNNDataflow IP busy")
+        self.hw_cycles = IP_wait(self.cnn)
+        if src is not ifm:
+            src.freebuffer()
+        ofm.invalidate()
+        return ofm
+
+    def cycles(self):
+        """ Cycle count of the last run read from the IP """
+        return self.cnn.read(CYCLE_COUNT_OFFSET, 4)
+
+    def executor(self, **kwargs):
+        """ Executor pipelining requests on this overlay's IP """
+        return Executor(self.cnn, self.pool, **kwargs)
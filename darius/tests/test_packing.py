@@ -0,0 +1,131 @@
+#   Copyright (c) 2018, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import contextlib
+import io
+import itertools
+import numpy as np
+import pytest
+from darius.lib.darius_lib import Darius, C_NUM_OF_ROWS, C_NUM_OF_COLS
+
+__author__ = ""
+__copyright__ = "Copyright 2018, Xilinx"
+__email__ = "pynq_support@xilinx.com"
+
+DIMENSIONS = (6, 13, 32)
+DEPTHS = (1, 3, 8, 13, 24)
+KERNELS = (1, 2, 3, 5, 7, 16)
+STRIDES = (1, 2)
+CHANNELS = (8, 16)
+
+
+def _layer(height, width, depth, kernel, stride, channels, pad=0):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return Darius(height, width, depth, kernel, kernel, pad, stride,
+                      channels, 0, 0, 0, 0, 0, 0)
+
+
+def _accepted(height, width, depth, kernel, stride, channels):
+    if kernel > min(height, width):
+        return False
+    with contextlib.redirect_stdout(io.StringIO()):
+        return _layer(height, width, depth, kernel, stride,
+                      channels).IP_cmd() is not False
+
+
+def _padded(layer):
+    """ Layer with the depth and channels zero padded to full slices, the
+    only shapes the element by element loops handle """
+    return _layer(layer.ifm_height, layer.ifm_width,
+                  layer.ifm_slices * C_NUM_OF_ROWS, layer.kernel_height,
+                  layer.stride, layer.ofm_slices * C_NUM_OF_COLS)
+
+
+GEOMETRIES = [geometry for geometry in itertools.product(
+    DIMENSIONS, DIMENSIONS, DEPTHS, KERNELS, STRIDES, CHANNELS)
+    if _accepted(*geometry)]
+
+
+def test_grid_is_not_empty():
+    assert len(GEOMETRIES) > 100
+
+
+@pytest.mark.parametrize('geometry', GEOMETRIES)
+def test_pack_ifm_matches_loops(geometry):
+    layer = _layer(*geometry)
+    ref_layer = _padded(layer)
+    rng = np.random.default_rng(sum(geometry))
+    ifm_sw = rng.integers(-1 << 15, 1 << 15, layer.ifm_depth *
+                          layer.ifm_height * layer.ifm_width,
+                          dtype=np.int16)
+    padded = np.zeros(ref_layer.ifm_depth * layer.ifm_height *
+                      layer.ifm_width, dtype=np.int16)
+    padded[:ifm_sw.size] = ifm_sw
+
+    ifm = np.full(layer.ifm_packet_length * C_NUM_OF_ROWS, 0x5555,
+                  dtype=np.int16)
+    expected = np.zeros_like(ifm)
+    layer.reshape_and_copy_ifm(ifm_sw, ifm)
+    ref_layer.reshape_and_copy_ifm_ref(padded, expected)
+    assert ifm.tobytes() == expected.tobytes()
+
+
+def _check_weights(layer):
+    ref_layer = _padded(layer)
+    kernel_size = layer.kernel_height * layer.kernel_width
+    rng = np.random.default_rng(layer.channels * layer.ifm_depth)
+    weights_sw = rng.integers(-1 << 15, 1 << 15,
+                              (layer.channels, layer.ifm_depth, kernel_size),
+                              dtype=np.int16)
+    padded = np.zeros((ref_layer.channels, ref_layer.ifm_depth, kernel_size),
+                      dtype=np.int16)
+    padded[:layer.channels, :layer.ifm_depth] = weights_sw
+
+    weights = np.full(layer.weight_depth_offset * layer.ofm_slices, 0x5555,
+                      dtype=np.int16)
+    expected = np.zeros_like(weights)
+    layer.reshape_and_copy_weights(weights_sw.ravel(), weights)
+    ref_layer.reshape_and_copy_weights_ref(padded.ravel(), expected)
+    assert weights.tobytes() == expected.tobytes()
+
+
+@pytest.mark.parametrize('geometry', GEOMETRIES)
+def test_pack_weights_matches_loops(geometry):
+    _check_weights(_layer(*geometry))
+
+
+@pytest.mark.parametrize('channels', (1, 5, 12, 20))
+@pytest.mark.parametrize('depth', (3, 8, 13))
+@pytest.mark.parametrize('kernel', (1, 3))
+def test_pack_weights_partial_channels(channels, depth, kernel):
+    # IP_cmd rejects these channel counts, but reshape_and_copy_weights
+    # still packs them for any layer, zero filling the lanes of the last
+    # OFM slice like the loops
+    _check_weights(_layer(8, 8, depth, kernel, 1, channels))
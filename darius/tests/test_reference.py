@@ -0,0 +1,118 @@
+#   Copyright (c) 2018, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import contextlib
+import io
+import numpy as np
+import pytest
+from darius.lib.darius_lib import Darius, C_NUM_OF_ROWS, C_NUM_OF_COLS
+from darius.lib.reference import run_IP_cmd
+
+__author__ = ""
+__copyright__ = "Copyright 2018, Xilinx"
+__email__ = "pynq_support@xilinx.com"
+
+# ifm height, width, depth, kernel, pad, stride, channels, pool kernel and
+# stride
+LAYERS = [
+    (14, 14, 64, 3, 0, 1, 32, 2, 2),
+    (31, 29, 16, 5, 2, 2, 24, 3, 2),
+    (8, 8, 8, 1, 0, 1, 8, 0, 0),
+    (32, 32, 32, 3, 1, 1, 16, 2, 2),
+    (20, 20, 8, 4, 1, 4, 8, 0, 0),
+    (12, 12, 13, 3, 1, 1, 8, 2, 2),
+]
+
+
+def _naive(ifm, weights, stride, pad, ofm_height, ofm_width):
+    """ Direct int64 convolution of a (depth, height, width) volume """
+    depth, height, width = ifm.shape
+    channels, _, kernel_height, kernel_width = weights.shape
+    padded = np.zeros((depth, height + 2 * pad + kernel_height * stride,
+                       width + 2 * pad + kernel_width * stride),
+                      dtype=np.int64)
+    padded[:, pad:pad + height, pad:pad + width] = ifm
+    ofm = np.zeros((channels, ofm_height, ofm_width), dtype=np.int64)
+    for i in range(ofm_height):
+        for j in range(ofm_width):
+            window = padded[:, i * stride:i * stride + kernel_height,
+                            j * stride:j * stride + kernel_width]
+            ofm[:, i, j] = np.tensordot(weights.astype(np.int64), window,
+                                        axes=([1, 2, 3], [0, 1, 2]))
+    return ofm
+
+
+def _naive_maxpool(ofm, kernel, stride, out_height, out_width):
+    pooled = np.empty(ofm.shape[:1] + (out_height, out_width),
+                      dtype=ofm.dtype)
+    for i in range(out_height):
+        for j in range(out_width):
+            pooled[:, i, j] = ofm[:, i * stride:i * stride + kernel,
+                                  j * stride:j * stride + kernel].max(
+                                      axis=(1, 2))
+    return pooled
+
+
+@pytest.mark.parametrize('geometry', LAYERS)
+def test_run_IP_cmd_matches_naive_convolution(geometry):
+    (height, width, depth, kernel, pad, stride, channels, pool_kernel,
+     pool_stride) = geometry
+    with contextlib.redirect_stdout(io.StringIO()):
+        layer = Darius(height, width, depth, kernel, kernel, pad, stride,
+                       channels, pool_kernel, pool_kernel, pool_stride,
+                       0, 0, 0)
+        cmd = layer.IP_cmd()
+    assert cmd is not False
+    rng = np.random.default_rng(depth * channels)
+    # Full range operands, so the 32-bit accumulators and the 16-bit
+    # output wrap
+    ifm_sw = rng.integers(-1 << 15, 1 << 15, (depth, height, width),
+                          dtype=np.int16)
+    weights_sw = rng.integers(-1 << 15, 1 << 15,
+                              (channels, depth, kernel, kernel),
+                              dtype=np.int16)
+    ifm = np.zeros(layer.ifm_packet_length * C_NUM_OF_ROWS, dtype=np.int16)
+    weights = np.zeros(layer.weight_depth_offset * layer.ofm_slices,
+                       dtype=np.int16)
+    layer.reshape_and_copy_ifm(ifm_sw.ravel(), ifm)
+    layer.reshape_and_copy_weights(weights_sw.ravel(), weights)
+    ofm = run_IP_cmd(cmd, ifm, weights)
+
+    expected = _naive(ifm_sw, weights_sw, stride, pad, layer.ofm_height,
+                      layer.ofm_width)
+    expected = (((expected + (1 << 31)) % (1 << 32)) -
+                (1 << 31)).astype(np.int16)
+    if layer.pool_stride != 0:
+        expected = _naive_maxpool(expected, layer.pool_kernel_height,
+                                  layer.pool_stride,
+                                  layer.pool_output_height,
+                                  layer.pool_output_width)
+    assert ofm.size == layer.ofm_packet_length * C_NUM_OF_COLS
+    assert np.array_equal(layer.unpack_ofm(ofm), expected)
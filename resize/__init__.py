@@ -32,4 +32,11 @@ __author__ = ""
 __copyright__ = "Copyright 2018, Xilinx"
 __email__ = ""
 
-from .overlays import Resize
+from .lib import *
+
+try:
+    from .overlays import Resize
+except ImportError:
+    # pynq is only available on the board; the software resizer stays
+    # usable off-board
+    pass
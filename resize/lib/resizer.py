@@ -0,0 +1,205 @@
+#   Copyright (c) 2018, Xilinx, Inc.
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+#   3.  Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+#   PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+#   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+#   OR BUSINESS INTERRUPTION). HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#   WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+#   OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import numpy as np
+
+__author__ = ""
+__copyright__ = "Copyright 2018, Xilinx"
+__email__ = "pynq_support@xilinx.com"
+
+# resize_accel registers
+RESIZE_CTRL_OFFSET = 0x00
+RESIZE_SRC_ROWS_OFFSET = 0x10
+RESIZE_SRC_COLS_OFFSET = 0x18
+RESIZE_DST_ROWS_OFFSET = 0x20
+RESIZE_DST_COLS_OFFSET = 0x28
+RESIZE_AP_START = 0x01
+# Largest frame of the resize_accel build, xf_config_params.h
+RESIZE_MAX_WIDTH = 640
+RESIZE_MAX_HEIGHT = 360
+RESIZE_CHANNELS = 3
+
+
+class _FrameResizer(object):
+    """ Interface of the hardware and software resizers: resize() one
+    (rows, cols, 3) uint8 frame, or resize_stream() an iterable of them, to
+    dst_shape (rows, cols) """
+
+    def resize(self, frame, dst_shape):
+        return next(self.resize_stream([frame], dst_shape))
+
+    def resize_stream(self, frames, dst_shape, copy=True):
+        """ Generator of the resized frames of an iterable of frames; every
+        frame yielded is a new array, so copy=False, which lets Resizer
+        yield views of its buffers, changes nothing here """
+        for frame in frames:
+            yield self._resize(frame, dst_shape)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _BufferPair(object):
+    def __init__(self, xlnk, src_shape, dst_shape):
+        self.src = xlnk.cma_array(shape=src_shape, dtype=np.uint8)
+        self.dst = xlnk.cma_array(shape=dst_shape, dtype=np.uint8)
+
+    def freebuffer(self):
+        self.src.freebuffer()
+        self.dst.freebuffer()
+
+
+class Resizer(_FrameResizer):
+    """ Driver of the resize_accel IP fed by an AXI DMA
+
+    The geometry registers are only written when the frame or output size
+    changes. resize_stream() cycles through buffers pairs of input and
+    output buffers: the next frame is copied in and the previous result
+    copied out while the DMA and the IP work on the current frame, so
+    frames are resized at the rate of the slower of the host copies and
+    the hardware.
+
+    The IP is started without auto-restart so each frame latches the
+    geometry registers it is started with """
+
+    def __init__(self, dma, resizer, xlnk=None, buffers=2):
+        if buffers < 2:
+            raise ValueError("At least 2 buffer pairs are needed to overlap "
+                             "the host and the hardware")
+        if xlnk is None:
+            from pynq import Xlnk
+            xlnk = Xlnk()
+        self.dma = dma
+        self.resizer = resizer
+        self.xlnk = xlnk
+        self.buffers = buffers
+        self._geometry = None
+        self._pairs = []
+
+    def _configure(self, src_shape, dst_shape):
+        """ Write the geometry registers and allocate the buffer pairs for
+        a new geometry; nothing is done when it is unchanged """
+        geometry = (src_shape[0], src_shape[1], dst_shape[0], dst_shape[1])
+        if geometry == self._geometry:
+            return
+        for rows, cols in (src_shape[:2], dst_shape[:2]):
+            if not (0 < rows <= RESIZE_MAX_HEIGHT and
+                    0 < cols <= RESIZE_MAX_WIDTH):
+                raise ValueError("Frame of %dx%d exceeds the %dx%d supported "
+                                 "by resize_accel" % (cols, rows,
+                                                      RESIZE_MAX_WIDTH,
+                                                      RESIZE_MAX_HEIGHT))
+        self.close()
+        for offset, value in zip((RESIZE_SRC_ROWS_OFFSET,
+                                  RESIZE_SRC_COLS_OFFSET,
+                                  RESIZE_DST_ROWS_OFFSET,
+                                  RESIZE_DST_COLS_OFFSET), geometry):
+            self.resizer.write(offset, value)
+        src = (geometry[0], geometry[1], RESIZE_CHANNELS)
+        dst = (geometry[2], geometry[3], RESIZE_CHANNELS)
+        self._pairs = [_BufferPair(self.xlnk, src, dst)
+                       for _ in range(self.buffers)]
+        self._geometry = geometry
+
+    def _start(self, pair):
+        self.dma.sendchannel.transfer(pair.src)
+        self.dma.recvchannel.transfer(pair.dst)
+        self.resizer.write(RESIZE_CTRL_OFFSET, RESIZE_AP_START)
+
+    def _wait(self):
+        self.dma.sendchannel.wait()
+        self.dma.recvchannel.wait()
+
+    def resize_stream(self, frames, dst_shape, copy=True):
+        """ Generator of the resized frames of an iterable of frames
+
+        With copy=False the frames yielded are views of the output buffers,
+        valid until the generator has been advanced buffers - 1 more
+        times. A change of the frame size frees the buffers, so the last
+        frame of the old size is yielded as a copy and the earlier views
+        are only valid until it has been taken """
+        running = None
+        index = 0
+        try:
+            for frame in frames:
+                frame = np.asarray(frame)
+                if running is not None and \
+                        frame.shape[:2] != self._pairs[0].src.shape[:2]:
+                    self._wait()
+                    last, running = running, None
+                    # Its buffer is freed by _configure() on the next frame
+                    yield last.dst.copy()
+                self._configure(frame.shape, dst_shape)
+                pair = self._pairs[index % self.buffers]
+                index += 1
+                # Fill the next input buffer while the IP is busy
+                np.copyto(pair.src, frame, casting='unsafe')
+                if running is not None:
+                    self._wait()
+                self._start(pair)
+                if running is not None:
+                    # Copy the previous result out while the IP is busy
+                    yield running.dst.copy() if copy else running.dst
+                running = pair
+            if running is not None:
+                self._wait()
+                last, running = running, None
+                yield last.dst.copy() if copy else last.dst
+        finally:
+            if running is not None:
+                self._wait()
+
+    def close(self):
+        """ Free the buffer pairs """
+        for pair in self._pairs:
+            pair.freebuffer()
+        self._pairs = []
+        self._geometry = None
+
+
+class SoftwareResizer(_FrameResizer):
+    """ Bilinear resize with PIL and the interface of Resizer, for off-board
+    use and for comparison with the hardware """
+
+    def __init__(self, resample=None):
+        from PIL import Image
+        self._image = Image
+        self.resample = Image.BILINEAR if resample is None else resample
+
+    def _resize(self, frame, dst_shape):
+        image = self._image.fromarray(np.asarray(frame, dtype=np.uint8))
+        return np.asarray(image.resize((dst_shape[1], dst_shape[0]),
+                                       self.resample))